@@ -1,8 +1,12 @@
 from typing import Union  # Объединение типов
 import collections
 from uuid import uuid4  # Номера заявок должны быть уникальными во времени и пространстве
-from threading import Thread
+from threading import Thread, Lock, local
+from concurrent.futures import ThreadPoolExecutor  # Пакет заявок отправляем/отменяем одновременно
+from contextlib import contextmanager
 import logging
+import os.path
+import json  # Журнал заявок и позиций храним в формате JSON
 
 from backtrader import BrokerBase, Order, BuyOrder, SellOrder
 from backtrader.position import Position
@@ -12,9 +16,18 @@ from BackTraderTinkoff import TKStore, TKData
 
 from TinkoffPy.grpc.operations_pb2 import PortfolioRequest, PortfolioResponse  # Портфель
 from TinkoffPy.grpc.orders_pb2 import (
-    PostOrderRequest, CancelOrderRequest, ORDER_DIRECTION_BUY, ORDER_DIRECTION_SELL, ORDER_TYPE_MARKET, ORDER_TYPE_LIMIT, OrderTrades)  # Заявка
+    PostOrderRequest, CancelOrderRequest, ORDER_DIRECTION_BUY, ORDER_DIRECTION_SELL, ORDER_TYPE_MARKET, ORDER_TYPE_LIMIT, OrderTrades,
+    OrderStateStreamResponse, EXECUTION_REPORT_STATUS_CANCELLED, EXECUTION_REPORT_STATUS_REJECTED, EXECUTION_REPORT_STATUS_FILL,
+    GetOrdersRequest, GetOrderStateRequest)  # Заявка
 from TinkoffPy.grpc.stoporders_pb2 import (
-    PostStopOrderRequest, CancelStopOrderRequest, STOP_ORDER_DIRECTION_BUY, STOP_ORDER_DIRECTION_SELL, StopOrderExpirationType, StopOrderType)  # Стоп-заявка
+    PostStopOrderRequest, CancelStopOrderRequest, GetStopOrdersRequest, STOP_ORDER_DIRECTION_BUY, STOP_ORDER_DIRECTION_SELL, StopOrderExpirationType, StopOrderType)  # Стоп-заявка
+
+
+class BatchState(local):
+    """Пакет заявок. У каждого потока свой пакет, поэтому заявки из потоков подписок не попадают в пакет ТС"""
+    orders = None  # Заявки на отправку пакетом. None - пакет не собираем
+    cancels = None  # Заявки на отмену пакетом
+    results = None  # Результаты пакета по номерам заявок
 
 
 # noinspection PyArgumentList
@@ -29,6 +42,9 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
     """Брокер Tinkoff"""
     logger = logging.getLogger('TKBroker')  # Будем вести лог
     currency = PortfolioRequest.CurrencyRequest.RUB  # Суммы будем получать в российских рублях
+    journal_file = None  # Журнал заявок и позиций для быстрого перезапуска. None - журнал не ведем. Например, os.path.join(TKData.datapath, 'TKBroker.json')
+    journal_key = None  # Ключ журнала, например, название ТС. Вместе со счетами входит в имя файла журнала, чтобы разные процессы не писали в один журнал
+    batch_workers = 16  # Кол-во потоков для одновременной отправки/отмены пакета заявок
 
     def __init__(self, **kwargs):
         super(TKBroker, self).__init__()
@@ -40,13 +56,21 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
         self.orders = collections.OrderedDict()  # Список заявок, отправленных на биржу
         self.ocos = {}  # Список связанных заявок (One Cancel Others)
         self.pcs = collections.defaultdict(collections.deque)  # Очередь всех родительских/дочерних заявок (Parent - Children)
+        self.journal_lock = Lock()  # Журнал могут записывать из разных потоков
+        self.journal_file_name = self.get_journal_file_name()  # Имя файла журнала по счетам и ключу
+        self.journal_entries = []  # Заявки журнала прошлого запуска по тикерам, которых нет в данных. Переносим в журнал без изменений
+        self.batch_state = BatchState()  # Пакеты заявок по потокам
+        self.cancel_refs = {}  # Номера подключения подписки на статусы заявок по номерам заявок, отмену которых принял брокер. Ждем статус из подписки
 
         self.store.provider.on_order_trades = self.on_order_trades  # Обработка сделок по заявке
         Thread(target=self.store.provider.subscriptions_trades_handler, name='SubscriptionsTradesThread', args=[accounts.id for accounts in self.store.provider.accounts]).start()  # Создаем и запускаем поток обработки подписок сделок по заявке
+        self.store.on_order_state = self.on_order_state  # Обработка изменения статуса заявки
+        Thread(target=self.store.subscriptions_order_state_handler, name='SubscriptionsOrderStateThread', args=([accounts.id for accounts in self.store.provider.accounts],)).start()  # Создаем и запускаем поток обработки подписки на статусы заявок
 
     def start(self):
         super(TKBroker, self).start()
         self.get_all_active_positions()  # Получаем все активные позиции
+        self.restore_journal()  # Восстанавливаем заявки из журнала прошлого запуска
 
     def getcash(self, account=None):
         """Свободные средства по счету, по всем счетам"""
@@ -64,14 +88,14 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
         value = 0  # Будем набирать стоимость позиций
         if self.store.BrokerCls:  # Если брокер есть в хранилище
             if datas:  # Если считаем стоимость позиции/позиций
-                data: TKData  # Данные Финам
+                data: TKData  # Данные Тинькофф
                 for data in datas:  # Пробегаемся по всем тикерам
-                    position = self.positions[(data.client_id, data.board, data.symbol)]  # Позиция по тикеру
-                    value += position.price * position.size  # Добавляем стоимость позиции по тикеру
+                    key = (data.account.id, data.class_code, data.symbol)  # Ключ позиции по тикеру
+                    value += self.get_position_value(key, self.positions[key])  # Добавляем стоимость позиции по тикеру
             elif account:  # Если считаем свободные средства по счету
-                value = sum([position.price * position.size for key, position in self.positions.items() if key[0] == account and key[1]])  # Стоимость позиций по портфелю/бирже
+                value = sum([self.get_position_value(key, position) for key, position in self.positions.items() if key[0] == account and key[1]])  # Стоимость позиций по портфелю/бирже
             else:  # Если считаем стоимость всех позиций
-                value = sum([position.price * position.size for key, position in self.positions.items() if key[1]])  # Стоимость всех позиций
+                value = sum([self.get_position_value(key, position) for key, position in self.positions.items() if key[1]])  # Стоимость всех позиций
                 self.value = value  # Сохраняем текущую стоимость позиций
         return value
 
@@ -87,13 +111,15 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
     def buy(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, tradeid=0, oco=None, trailamount=None, trailpercent=None, parent=None, transmit=True, **kwargs):
         """Заявка на покупку"""
         order = self.create_order(owner, data, size, price, plimit, exectype, valid, oco, parent, transmit, True, **kwargs)
-        self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
+        if not self.in_batch(order):  # Заявку из пакета уведомим при отправке пакета
+            self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
         return order
 
     def sell(self, owner, data, size, price=None, plimit=None, exectype=None, valid=None, tradeid=0, oco=None, trailamount=None, trailpercent=None, parent=None, transmit=True, **kwargs):
         """Заявка на продажу"""
         order = self.create_order(owner, data, size, price, plimit, exectype, valid, oco, parent, transmit, False, **kwargs)
-        self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
+        if not self.in_batch(order):  # Заявку из пакета уведомим при отправке пакета
+            self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
         return order
 
     def cancel(self, order):
@@ -104,11 +130,13 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
         return self.notifs.popleft() if self.notifs else None  # Удаляем и возвращаем крайний левый элемент списка уведомлений или ничего
 
     def next(self):
+        self.check_cancel_refs()  # Снимаем заявки, статусы отмены которых могли не прийти по подписке
         self.notifs.append(None)  # Добавляем в список уведомлений пустой элемент
 
     def stop(self):
         super(TKBroker, self).stop()
         self.store.provider.on_order_trades = self.store.provider.default_handler  # Обработка сделок по заявке
+        self.store.on_order_state = self.store.provider.default_handler  # Обработка изменения статуса заявки
         self.store.BrokerCls = None  # Удаляем класс брокера из хранилища
 
     # Функции
@@ -119,17 +147,32 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
         value = 0  # Будем набирать стоимость позиций
         for account in self.store.provider.accounts:
             request = PortfolioRequest(account_id=account.id, currency=self.currency)  # Запрос портфеля по счету в рублях
-            response: PortfolioResponse = self.store.provider.call_function(self.store.provider.stub_operations.GetPortfolio, request)  # Портфель по счету
+            response: PortfolioResponse = self.store.call_function(self.store.provider.stub_operations, 'GetPortfolio', request, self.store.priority_portfolio)  # Портфель по счету
             cash += self.store.provider.money_value_to_float(response.total_amount_currencies, self.currency)  # Увеличиваем общий размер свободных средств
             for position in response.positions:  # Пробегаемся по всем активным позициям счета
-                si = self.store.provider.figi_to_symbol_info(position.figi)  # Поиск тикера по уникальному коду
+                si = self.store.figi_to_symbol_info(position.figi, self.store.priority_portfolio)  # Поиск тикера по уникальному коду
                 size = self.store.provider.quotation_to_float(position.quantity)  # Кол-во в штуках
                 price = self.store.provider.money_value_to_float(position.average_position_price)  # Цена входа
                 value += price * size  # Увеличиваем общий размер стоимости позиций
                 self.positions[(account.id, si.class_code, si.ticker)] = Position(size, price)  # Сохраняем в списке открытых позиций
+                self.store.subscribe_last_price(position.figi)  # Стоимость позиции будем пересчитывать по последним ценам
         self.cash = cash  # Сохраняем текущие свободные средства
         self.value = value  # Сохраняем текущую стоимость позиций
 
+    def get_position_value(self, key, position: Position) -> float:
+        """Стоимость позиции по последней цене из подписки. Если последней цены еще нет, то по цене входа
+
+        :param tuple key: Ключ позиции (счет, код режима торгов, тикер)
+        :param Position position: Позиция
+        :return: Стоимость позиции
+        """
+        class_code, symbol = key[1], key[2]  # Код режима торгов и тикер
+        figi = self.store.get_symbol_info(class_code, symbol, self.store.priority_portfolio).figi  # Уникальный код тикера
+        last_price = self.store.last_prices.get(figi)  # Последняя цена в единицах Тинькофф: для облигаций в процентах от номинала, для фьючерсов в пунктах
+        if last_price is None:  # Если последней цены еще нет
+            return position.price * position.size  # то стоимость по цене входа в деньгах
+        return self.store.provider.tinkoff_price_to_price(class_code, symbol, last_price) * position.size  # Последнюю цену переводим в деньги, как и цену входа
+
     def get_order(self, order_id: str) -> Union[Order, None]:
         """Заявка BackTrader по номеру заявки на бирже
         Пробегаемся по всем заявкам на бирже. Если нашли совпадение с номером заявки на бирже, то возвращаем заявку BackTrader. Иначе, ничего не найдено
@@ -184,75 +227,275 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
                 self.notifs.append(order.clone())  # Удедомляем брокера о создании новой заявки
                 return self.place_order(order.parent)  # Отправляем родительскую заявку на биржу
         # Если не последняя заявка в цепочке родительской/дочерних заявок (transmit=False)
+        self.save_journal()  # Сохраняем заявку в журнал
         return order  # то возвращаем созданную заявку со статусом Created. На биржу ее пока не ставим
 
     def place_order(self, order: Order):
-        """Отправка заявки на биржу"""
+        """Отправка заявки на биржу. Внутри пакета заявка отправляется при выходе из пакета"""
+        if self.batch_state.orders is not None:  # Если в этом потоке собираем пакет
+            self.batch_state.orders.append(order)  # то добавляем заявку в пакет
+            return order  # Возвращаем заявку со статусом Created
+        stub, method, request = self.get_place_request(order)  # Запрос на постановку заявки
+        response = self.store.call_function(stub, method, request, self.store.priority_order)
+        self.on_place_response(order, response)  # Обрабатываем ответ брокера
+        if order.status == Order.Rejected:  # Если заявка отклонена
+            self.oco_pc_check(order)  # то проверяем связанные и родительскую/дочерние заявки
+        self.save_journal()  # Сохраняем заявку в журнал
+        return order  # Возвращаем заявку
+
+    def place_orders(self, orders) -> dict:
+        """Одновременная отправка заявок на биржу
+        Уведомления ставятся в порядке заявок. Связанные и родительскую/дочерние заявки проверяем после обработки всего пакета
+
+        :param list orders: Заявки со статусом Created
+        :return: Результаты по номерам заявок: True - заявка принята, False - отклонена
+        """
+        responses = self.call_functions([self.get_place_request(order) for order in orders], self.store.priority_order)  # Отправляем все заявки одновременно
+        for order, response in zip(orders, responses):  # Пробегаемся по заявкам в порядке пакета
+            self.on_place_response(order, response)  # Обрабатываем ответ брокера
+            self.notifs.append(order.clone())  # Уведомляем брокера о принятии/отклонении зявки на бирже
+        results = {order.ref: order.status == Order.Accepted for order in orders}  # Результаты до отмены связанных заявок
+        self.oco_pc_check_orders([order for order in orders if order.status == Order.Rejected])  # Когда все принятые заявки уже в списке, проверяем связанные и родительскую/дочерние заявки отклоненных заявок
+        if orders:  # Если были заявки
+            self.save_journal()  # то сохраняем их в журнал
+        return results
+
+    def get_place_request(self, order: Order):
+        """Запрос на постановку заявки
+
+        :param Order order: Заявка
+        :return: Сервис, название функции сервиса, запрос
+        """
         account = order.info['account']  # Торговый счет
         class_code = order.data.class_code  # Код режима торгов
         symbol = order.data.symbol  # Тикер
-        si = self.store.provider.get_symbol_info(class_code, symbol)  # Поиск тикера по коду площадки/названию
+        si = self.store.get_symbol_info(class_code, symbol, self.store.priority_order)  # Поиск тикера по коду площадки/названию
         quantity: int = abs(order.size // si.lot)  # Размер позиции в лотах. В Тинькофф всегда передается положительный размер лота
         order_id = str(uuid4())  # Уникальный идентификатор заявки
-        response = None  # Результат запроса
         if order.exectype == Order.Market:  # Рыночная заявка
             direction = ORDER_DIRECTION_BUY if order.isbuy() else ORDER_DIRECTION_SELL  # Покупка/продажа
             request = PostOrderRequest(instrument_id=si.figi, quantity=quantity, direction=direction, account_id=account, order_type=ORDER_TYPE_MARKET, order_id=order_id)
-            response = self.store.provider.call_function(self.store.provider.stub_orders.PostOrder, request)
+            return self.store.provider.stub_orders, 'PostOrder', request
         elif order.exectype == Order.Limit:  # Лимитная заявка
             direction = ORDER_DIRECTION_BUY if order.isbuy() else ORDER_DIRECTION_SELL  # Покупка/продажа
             price = self.store.provider.float_to_quotation(self.store.provider.price_to_tinkoff_price(class_code, symbol, order.price))  # Лимитная цена
             request = PostOrderRequest(instrument_id=si.figi, quantity=quantity, price=price, direction=direction, account_id=account, order_type=ORDER_TYPE_LIMIT, order_id=order_id)
-            response = self.store.provider.call_function(self.store.provider.stub_orders.PostOrder, request)
+            return self.store.provider.stub_orders, 'PostOrder', request
         elif order.exectype == Order.Stop:  # Стоп заявка
             direction = STOP_ORDER_DIRECTION_BUY if order.isbuy() else STOP_ORDER_DIRECTION_SELL  # Покупка/продажа
             price = self.store.provider.float_to_quotation(self.store.provider.price_to_tinkoff_price(class_code, symbol, order.price))  # Стоп цена
             request = PostStopOrderRequest(instrument_id=si.figi, quantity=quantity, stop_price=price, direction=direction, account_id=account,
                                            expiration_type=StopOrderExpirationType.STOP_ORDER_EXPIRATION_TYPE_GOOD_TILL_CANCEL, stop_order_type=StopOrderType.STOP_ORDER_TYPE_STOP_LOSS)
-            response = self.store.provider.call_function(self.store.provider.stub_stop_orders.PostStopOrder, request)
+            return self.store.provider.stub_stop_orders, 'PostStopOrder', request
         elif order.exectype == Order.StopLimit:  # Стоп-лимитная заявка
             direction = STOP_ORDER_DIRECTION_BUY if order.isbuy() else STOP_ORDER_DIRECTION_SELL  # Покупка/продажа
             price = self.store.provider.float_to_quotation(self.store.provider.price_to_tinkoff_price(class_code, symbol, order.price))  # Стоп цена
             pricelimit = self.store.provider.float_to_quotation(self.store.provider.price_to_tinkoff_price(class_code, symbol, order.pricelimit))  # Лимитная цена
             request = PostStopOrderRequest(instrument_id=si.figi, quantity=quantity, stop_price=price, price=pricelimit, direction=direction, account_id=account,
                                            expiration_type=StopOrderExpirationType.STOP_ORDER_EXPIRATION_TYPE_GOOD_TILL_CANCEL, stop_order_type=StopOrderType.STOP_ORDER_TYPE_STOP_LIMIT)
-            response = self.store.provider.call_function(self.store.provider.stub_stop_orders.PostStopOrder, request)
+            return self.store.provider.stub_stop_orders, 'PostStopOrder', request
+
+    def on_place_response(self, order: Order, response) -> None:
+        """Обработка ответа брокера на постановку заявки. Связанные и родительскую/дочерние заявки не проверяем
+
+        :param Order order: Заявка
+        :param response: Ответ брокера или None, если произошла ошибка
+        """
         order.submit(self)  # Отправляем заявку на биржу (Order.Submitted)
         self.notifs.append(order.clone())  # Уведомляем брокера об отправке заявки на биржу
         if not response:  # Если при отправке заявки на биржу произошла веб ошибка
-            self.logger.warning(f'Постановка заявки по тикеру {class_code}.{symbol} отклонена. Ошибка веб сервиса')
+            self.logger.warning(f'Постановка заявки по тикеру {order.data.class_code}.{order.data.symbol} отклонена. Ошибка веб сервиса')
             order.reject(self)  # то отклоняем заявку
-            self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
-            return order  # Возвращаем отклоненную заявку
+            return  # Выходим, дальше не продолжаем
         if order.exectype in (Order.Market, Order.Limit):  # Для рыночной и лимитной заявки
             order.addinfo(order_id=response.order_id)  # Номер заявки добавляем в заявку
         elif order.exectype in (Order.Stop, Order.StopLimit):  # Для стоп и стоп-лимитной заявки
             order.addinfo(stop_order_id=response.stop_order_id)  # Уникальный идентификатор стоп-заявки добавляем в заявку
         order.accept(self)  # Заявка принята на бирже (Order.Accepted)
         self.orders[order.ref] = order  # Сохраняем заявку в списке заявок, отправленных на биржу
-        return order  # Возвращаем заявку
 
     def cancel_order(self, order):
-        """Отмена заявки"""
-        # TODO Ждем от Тинькофф подписку на изменение статуса заявки. Пока нужно снимать заявки руками до окончания торговой сессии
-        if not order.alive():  # Если заявка уже была завершена
+        """Отмена заявки
+        Рыночная и лимитная заявки отменяются по приходу статуса из подписки. Если подписки нет, то по ответу брокера
+        Стоп заявки в подписку на статусы не входят. Их отменяем по ответу брокера
+        Внутри пакета заявка отменяется при выходе из пакета
+        """
+        if not order.alive() or order.ref in self.cancel_refs:  # Если заявка уже была завершена или ее отмену уже принял брокер
             return None  # то выходим, дальше не продолжаем
+        if self.batch_state.cancels is not None:  # Если в этом потоке собираем пакет
+            self.batch_state.cancels.append(order)  # то добавляем заявку в пакет
+            return order  # Возвращаем заявку
+        self.cancel_orders([order])  # Отменяем заявку
+        return order  # Для рыночной и лимитной заявки при подписке в список уведомлений ничего не добавляем. Ждем события on_order_state
+
+    def cancel_orders(self, orders) -> dict:
+        """Одновременная отмена заявок
+        Уведомления ставятся в порядке заявок. Связанные и родительскую/дочерние заявки проверяем после отмены всего пакета,
+        поэтому заявки пакета не отменяются повторно по цепочке
+
+        :param list orders: Заявки
+        :return: Результаты по номерам заявок: True - брокер принял отмену, False - заявка не снята
+        """
+        orders = [order for order in {order.ref: order for order in orders}.values() if order.alive() and order.ref not in self.cancel_refs]  # Уникальные активные заявки без принятой отмены
+        sent_orders = [order for order in orders if order.status != Order.Created]  # Заявки, отправленные на биржу. Остальные отменяем без запроса
+        session = self.store.order_state_session  # Подключение подписки на статусы заявок до запроса отмены
+        stream_refs = {order.ref for order in sent_orders if order.exectype in (Order.Market, Order.Limit) and self.store.order_state_live}  # Заявки, статусы отмены которых приходят по подписке
+        for ref in stream_refs:  # Статус отмены по подписке может прийти раньше ответа на запрос
+            self.cancel_refs[ref] = None  # поэтому ждем его до запроса. None - запрос отмены выполняется
+        responses = dict(zip((order.ref for order in sent_orders), self.call_functions([self.get_cancel_request(order) for order in sent_orders], self.store.priority_cancel)))  # Отменяем все заявки одновременно
+        results = {}  # Результаты по номерам заявок
+        canceled = []  # Отмененные заявки
+        for order in orders:  # Пробегаемся по заявкам в порядке пакета
+            if order.status == Order.Created:  # Если заявка не отправлялась на биржу
+                results[order.ref] = True  # то она всегда снимается
+            else:  # Если заявка на бирже
+                results[order.ref] = bool(responses[order.ref])  # то смотрим на ответ брокера
+                if order.ref in stream_refs:  # Если статус отмены приходит по подписке
+                    if not results[order.ref]:  # Если заявка не снята
+                        self.cancel_refs.pop(order.ref, None)  # то статус отмены не ждем
+                    elif order.ref in self.cancel_refs:  # Если статус отмены еще не пришел
+                        self.cancel_refs[order.ref] = session  # то ждем события on_order_state в подключении подписки до запроса
+                    continue  # Переходим к следующей заявке
+                if not results[order.ref]:  # Если заявка не снята
+                    continue  # то переходим к следующей заявке
+            order.cancel()  # Отменяем существующую заявку
+            self.notifs.append(order.clone())  # Уведомляем брокера об отмене заявки
+            canceled.append(order)
+        self.oco_pc_check_orders(canceled)  # Проверяем связанные и родительскую/дочерние заявки (Canceled)
+        if canceled:  # Если были отмененные заявки
+            self.save_journal()  # то сохраняем изменения в журнал
+        return results
+
+    def check_cancel_refs(self) -> None:
+        """Снятие заявок, отмену которых принял брокер, если подписка на статусы заявок оборвалась или была переподключена
+        Статусы отмены могли быть пропущены, поэтому снимаем заявки по ответу на запрос отмены, как без подписки
+        """
+        if not self.cancel_refs:  # Если статусов отмены не ждем
+            return  # то выходим, дальше не продолжаем
+        session = self.store.order_state_session if self.store.order_state_live else None  # Текущее подключение подписки. None - подписки нет
+        canceled = []  # Отмененные заявки
+        for ref, order_session in list(self.cancel_refs.items()):  # Пробегаемся по всем заявкам, статусы отмены которых ждем
+            order = self.orders.get(ref)  # Заявка BackTrader
+            if order is None or not order.alive():  # Если заявки нет или она уже завершена
+                self.cancel_refs.pop(ref, None)  # то статус отмены больше не ждем
+                continue  # Переходим к следующей заявке
+            if order_session is None or order_session == session:  # Если запрос отмены еще выполняется или статус еще может прийти по подписке
+                continue  # то переходим к следующей заявке
+            self.cancel_refs.pop(ref, None)  # Статус отмены больше не ждем
+            self.logger.warning(f'Статус отмены заявки {order.info["order_id"]} по подписке не получен. Заявка снята по ответу брокера')
+            order.cancel()  # Отменяем существующую заявку
+            self.notifs.append(order.clone())  # Уведомляем брокера об отмене заявки
+            canceled.append(order)
+        self.oco_pc_check_orders(canceled)  # Проверяем связанные и родительскую/дочерние заявки (Canceled)
+        if canceled:  # Если были отмененные заявки
+            self.save_journal()  # то сохраняем изменения в журнал
+
+    def cancel_all(self, account=None, data=None, order=None) -> dict:
+        """Отмена всех активных заявок по счету, тикеру, группе связанных и родительской/дочерних заявок. Без параметров - все заявки
+
+        :param str account: Торговый счет
+        :param TKData data: Данные тикера
+        :param Order order: Любая заявка из группы связанных и родительской/дочерних заявок
+        :return: Результаты по номерам заявок: True - брокер принял отмену, False - заявка не снята
+        """
+        orders = {order.ref: order for order in list(self.orders.values())}  # Заявки, отправленные на биржу
+        orders.update((order.ref, order) for pcs in list(self.pcs.values()) for order in list(pcs))  # Родительские/дочерние заявки, в т.ч. еще не отправленные на биржу
+        refs = self.get_group_refs(order, orders) if order else orders.keys()  # Номера заявок группы или все номера заявок
+        orders = [orders[ref] for ref in sorted(refs) if ref in orders and  # Заявки в порядке создания
+                  (not account or orders[ref].info['account'] == account) and (data is None or orders[ref].data is data)]  # по счету и тикеру. Линии BackTrader переопределяют bool, поэтому сравниваем с None
+        return self.cancel_orders(orders)
+
+    def get_group_refs(self, order, orders) -> set:
+        """Номера всех заявок группы связанных и родительской/дочерних заявок
+
+        :param Order order: Заявка группы
+        :param dict orders: Заявки по номерам
+        :return: Номера заявок группы
+        """
+        refs = set()  # Номера найденных заявок группы
+        queue = [order.ref]  # Номера заявок, связи которых нужно проверить
+        while queue:  # Пока есть непроверенные заявки
+            ref = queue.pop()
+            if ref in refs:  # Если заявку уже проверяли
+                continue  # то пропускаем ее
+            refs.add(ref)
+            queue.extend(order_ref for order_ref, oco_ref in self.ocos.items() if oco_ref == ref)  # Заявки, у которых эта заявка указана как связанная
+            if ref in self.ocos:  # Если у этой заявки указана связанная заявка
+                queue.append(self.ocos[ref])  # то добавляем ее
+            group_order = orders.get(ref)
+            if group_order:  # Если заявка известна
+                parent_ref = group_order.parent.ref if group_order.parent else ref  # Номер родительской заявки
+                queue.extend(pc.ref for pc in self.pcs.get(parent_ref, ()))  # Родительская и все дочерние заявки
+        return refs
+
+    @contextmanager
+    def batch(self):
+        """Пакет заявок. Заявки, поставленные и отмененные внутри блока with, отправляются на биржу одновременно при выходе из блока
+        Если в блоке произошла ошибка, то заявки пакета отклоняются без отправки на биржу, а отмены заявок отправляются
+        Уведомление о создании заявки пакета не ставится. Уведомления об отправке и принятии/отклонении ставятся при выходе из блока
+        with self.broker.batch() as results:
+            self.sell(data=data1)
+            self.cancel(order)
+
+        :return: Результаты по номерам заявок: True - заявка принята/снята, False - отклонена/не снята. Заполняются при выходе из блока
+        """
+        state = self.batch_state  # Пакет этого потока
+        if state.results is not None:  # Если пакет уже собирается
+            yield state.results  # то заявки попадут во внешний пакет
+            return  # Выходим, дальше не продолжаем
+        state.orders, state.cancels, state.results = [], [], {}  # Начинаем собирать пакет
+        orders, cancels, results = state.orders, state.cancels, state.results
+        try:
+            yield results
+        except BaseException:  # Если в блоке произошла ошибка, то часть заявок пакета могла быть не создана
+            state.orders = state.cancels = state.results = None  # Пакет собран
+            results.update(self.reject_orders(orders))  # Заявки пакета на биржу не отправляем
+            results.update(self.cancel_orders(cancels))  # Отмены отправляем
+            raise
+        state.orders = state.cancels = state.results = None  # Пакет собран
+        results.update(self.place_orders(orders))  # Сначала ставим заявки
+        results.update(self.cancel_orders(cancels))  # Затем снимаем
+
+    def in_batch(self, order) -> bool:
+        """Заявка ждет отправки в пакете этого потока"""
+        return any(batch_order is order for batch_order in self.batch_state.orders or ())
+
+    def reject_orders(self, orders) -> dict:
+        """Отклонение заявок без отправки на биржу
+
+        :param list orders: Заявки со статусом Created
+        :return: Результаты по номерам заявок: всегда False
+        """
+        for order in orders:  # Пробегаемся по заявкам в порядке пакета
+            order.reject(self)  # Отклоняем заявку
+            self.notifs.append(order.clone())  # Уведомляем брокера об отклонении заявки
+        self.oco_pc_check_orders(orders)  # Проверяем связанные и родительскую/дочерние заявки (Rejected)
+        if orders:  # Если были заявки
+            self.save_journal()  # то сохраняем изменения в журнал
+        return {order.ref: False for order in orders}
+
+    def call_functions(self, requests, priority) -> list:
+        """Одновременный вызов функций Тинькофф
+
+        :param list requests: Сервис, название функции сервиса, запрос
+        :param int priority: Приоритет запросов
+        :return: Ответы в порядке запросов
+        """
+        if len(requests) < 2:  # Один запрос
+            return [self.store.call_function(stub, method, request, priority) for stub, method, request in requests]  # выполняем в текущем потоке
+        with ThreadPoolExecutor(max_workers=min(self.batch_workers, len(requests)), thread_name_prefix='TKBrokerBatch') as executor:
+            return list(executor.map(lambda r: self.store.call_function(*r, priority), requests))  # map сохраняет порядок запросов
+
+    def get_cancel_request(self, order: Order):
+        """Запрос на отмену заявки
+
+        :param Order order: Заявка
+        :return: Сервис, название функции сервиса, запрос
+        """
         account = order.info['account']  # Торговый счет
         if order.exectype in (Order.Market, Order.Limit):  # Для рыночной и лимитной заявки
-            request = CancelOrderRequest(account_id=account, order_id=order.info['order_id'])  # Отмена активной заявки
-            response = self.store.provider.call_function(self.store.provider.stub_orders.CancelOrder, request)
-            if response:  # TODO Ждем от Тинькофф подписку на изменение статуса заявки. Отменять будем не по ответу брокера, а по приходу статуса
-                order.cancel()  # Отменяем существующую заявку
-                self.notifs.append(order.clone())  # Уведомляем брокера об отмене заявки
-                self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Canceled)
-        elif order.exectype in (Order.Stop, Order.StopLimit):  # Для стоп и стоп-лимитной заявки
-            request = CancelStopOrderRequest(account_id=account, stop_order_id=order.info['stop_order_id'])  # Отмена активной стоп заявки
-            response = self.store.provider.call_function(self.store.provider.stub_stop_orders.CancelStopOrder, request)
-            if response:  # TODO Ждем от Тинькофф подписку на изменение статуса заявки. Отменять будем не по ответу брокера, а по приходу статуса
-                order.cancel()  # Отменяем существующую заявку
-                self.notifs.append(order.clone())  # Уведомляем брокера об отмене заявки
-                self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Canceled)
-        return order  # В список уведомлений ничего не добавляем. Ждем события on_order
+            return self.store.provider.stub_orders, 'CancelOrder', CancelOrderRequest(account_id=account, order_id=order.info['order_id'])  # Отмена активной заявки
+        return self.store.provider.stub_stop_orders, 'CancelStopOrder', CancelStopOrderRequest(account_id=account, stop_order_id=order.info['stop_order_id'])  # Отмена активной стоп заявки
 
     def oco_pc_check(self, order):
         """
@@ -261,9 +504,9 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
         """
         ocos = self.ocos.copy()  # Пока ищем связанные заявки, они могут измениться. Поэтому, работаем с копией
         for order_ref, oco_ref in ocos.items():  # Пробегаемся по списку связанных заявок
-            if oco_ref == order.ref:  # Если в заявке номер эта заявка указана как связанная (по номеру транзакции)
+            if oco_ref == order.ref and order_ref in self.orders:  # Если в заявке номер эта заявка указана как связанная (по номеру транзакции), и заявка была на бирже
                 self.cancel_order(self.orders[order_ref])  # то отменяем заявку
-        if order.ref in ocos.keys():  # Если у этой заявки указана связанная заявка
+        if order.ref in ocos.keys() and ocos[order.ref] in self.orders:  # Если у этой заявки указана связанная заявка, и она была на бирже
             oco_ref = ocos[order.ref]  # то получаем номер транзакции связанной заявки
             self.cancel_order(self.orders[oco_ref])  # отменяем связанную заявку
 
@@ -278,8 +521,40 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
                 if child.parent and child.ref != order.ref:  # Пропускаем первую (родительскую) заявку и исполненную заявку
                     self.cancel_order(child)  # Отменяем дочернюю заявку
 
+    def oco_pc_check_orders(self, orders) -> None:
+        """Проверка связанных и родительской/дочерних заявок пакета. Заявки, отменяемые по цепочке, тоже отменяем пакетом
+
+        :param list orders: Завершенные заявки пакета
+        """
+        state = self.batch_state  # Пакет этого потока. Потоки подписок собирают свои пакеты
+        batch_cancels, state.cancels = state.cancels, []  # Отмены по цепочке собираем в пакет
+        try:
+            for order in orders:  # Пробегаемся по всем заявкам пакета
+                self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки
+        finally:
+            cancels, state.cancels = state.cancels, batch_cancels  # Возвращаем пакет, который собирался до проверки
+        if cancels:  # Если нужно отменить заявки по цепочке
+            self.cancel_orders(cancels)  # то отменяем их одновременно
+
+    def on_order_state(self, order_state: OrderStateStreamResponse.OrderState):
+        """Обработка изменения статуса заявки по подписке. Исполнение заявки обрабатываем в on_order_trades"""
+        order: Order = self.get_order(order_state.order_id)  # Заявка BackTrader
+        if not order or not order.alive():  # Если заявка не наша или уже завершена
+            return  # то выходим, дальше не продолжаем
+        if order_state.execution_report_status == EXECUTION_REPORT_STATUS_CANCELLED:  # Если заявка отменена
+            order.cancel()  # то отменяем существующую заявку
+        elif order_state.execution_report_status == EXECUTION_REPORT_STATUS_REJECTED:  # Если заявка отклонена
+            order.reject(self)  # то отклоняем заявку
+        else:  # Для остальных статусов
+            return  # выходим, дальше не продолжаем
+        self.cancel_refs.pop(order.ref, None)  # Отмена/отклонение пришли по подписке
+        self.notifs.append(order.clone())  # Уведомляем брокера об отмене/отклонении заявки
+        self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Canceled/Rejected)
+        self.save_journal()  # Сохраняем изменения в журнал
+
     def on_order_trades(self, event: OrderTrades):
         order: Order = self.get_order(event.order_id)  # Заявка BackTrader
+        self.store.subscribe_last_price(event.figi)  # Стоимость позиции будем пересчитывать по последним ценам
         for trade in event.trades:  # Пробегаемся по всем сделкам заявки
             dt = self.store.provider.timestamp_to_msk_datetime(trade.date_time)  # Дата и время сделки по времени биржи (МСК)
             pos = self.getposition(order.data)  # Получаем позицию по тикеру или нулевую позицию если тикера в списке позиций нет
@@ -293,7 +568,166 @@ class TKBroker(with_metaclass(MetaTKBroker, BrokerBase)):
                     self.notifs.append(order.clone())  # Уведомляем брокера о частичном исполнении заявки
             else:  # Если зничего нет к исполнению
                 order.completed()  # то заявка полностью исполнена
+                self.cancel_refs.pop(order.ref, None)  # Заявка могла исполниться до прихода отмены
                 self.notifs.append(order.clone())  # Уведомляем брокера о полном исполнении заявки
                 # Снимаем oco-заявку только после полного исполнения заявки
                 # Если нужно снять oco-заявку на частичном исполнении, то прописываем это правило в ТС
                 self.oco_pc_check(order)  # Проверяем связанные и родительскую/дочерние заявки (Completed)
+        self.save_journal()  # Сохраняем изменения заявки и позиции в журнал
+
+    # Журнал
+
+    def get_journal_file_name(self):
+        """Имя файла журнала. В имя входят счета и ключ журнала
+
+        :return: Имя файла журнала или None, если журнал не ведем
+        """
+        if not self.journal_file:  # Если журнал не ведем
+            return None  # то и файла журнала нет
+        name, ext = os.path.splitext(self.journal_file)  # Имя и расширение файла журнала
+        keys = [account.id for account in self.store.provider.accounts]  # Журнал ведем по счетам
+        if self.journal_key:  # Если задан ключ журнала
+            keys.append(str(self.journal_key))  # то добавляем его
+        return f'{name}_{"_".join(keys)}{ext}'
+
+    def save_journal(self) -> None:
+        """Сохранение журнала активных заявок, их связей и позиций"""
+        if not self.journal_file_name:  # Если журнал не ведем
+            return  # то выходим, дальше не продолжаем
+        orders = {order.ref: order for order in list(self.orders.values()) if order.alive()}  # Активные заявки на бирже. Заявки могут меняться из других потоков. Поэтому, работаем с копией
+        orders.update((order.ref, order) for pcs in list(self.pcs.values()) for order in list(pcs) if order.alive())  # Родительские/дочерние заявки, в т.ч. еще не отправленные на биржу
+        journal = dict(
+            orders=[dict(ref=order.ref, account=order.info['account'], dataname=f'{order.data.class_code}.{order.data.symbol}', buy=order.isbuy(), size=abs(order.size),
+                         exectype=order.exectype, price=order.price, pricelimit=order.pricelimit, status=order.status,
+                         order_id=order.info.get('order_id'), stop_order_id=order.info.get('stop_order_id'),
+                         oco=self.ocos.get(order.ref), parent=order.parent.ref if order.parent else None, transmit=order.transmit)
+                    for order in sorted(orders.values(), key=lambda order: order.ref)] + self.journal_entries,  # Заявки в порядке создания. Родительская заявка всегда раньше дочерних. Затем заявки по тикерам без данных
+            positions=[[*key, position.size, position.price] for key, position in list(self.positions.items()) if key[1] and position.size])  # Позиции по тикерам
+        with self.journal_lock:  # Журнал записываем из одного потока
+            tmp_file_name = f'{self.journal_file_name}.tmp'  # Журнал записываем во временный файл, чтобы не потерять его при сбое
+            try:
+                with open(tmp_file_name, 'w') as file:  # Создаем временный файл
+                    json.dump(journal, file, separators=(',', ':'))  # Записываем журнал без пробелов
+                os.replace(tmp_file_name, self.journal_file_name)  # Заменяем журнал
+            except OSError as e:  # Заявка уже на бирже. Ошибка записи журнала не должна останавливать ТС
+                self.logger.warning(f'Ошибка записи журнала {self.journal_file_name}: {e}')
+
+    def restore_journal(self) -> None:
+        """Восстановление заявок из журнала прошлого запуска
+        Сверяем журнал с активными заявками на бирже. Заявки, которые остались на бирже, восстанавливаем со связями
+        Если родительская заявка была исполнена, пока нас не было, то ставим на биржу ее дочерние заявки
+        """
+        if not self.journal_file_name or not os.path.isfile(self.journal_file_name):  # Если журнал не ведем или журнала нет
+            return  # то выходим, дальше не продолжаем
+        try:
+            with open(self.journal_file_name) as file:  # Открываем журнал
+                journal = json.load(file)  # Читаем журнал
+        except (OSError, ValueError) as e:  # Если журнал не прочитать
+            self.logger.warning(f'Ошибка чтения журнала {self.journal_file_name}: {e}')
+            return  # то выходим, дальше не продолжаем
+        for account, class_code, symbol, size, price in journal['positions']:  # Пробегаемся по всем позициям из журнала
+            position = self.positions.get((account, class_code, symbol))  # Позиция по тикеру на бирже
+            if not position or position.size != size:  # Если позиция на бирже изменилась
+                self.logger.warning(f'Позиция по тикеру {class_code}.{symbol} изменилась. В журнале {size}, на бирже {position.size if position else 0}')
+        if len(journal['orders']) == 0:  # Если в журнале нет заявок
+            return  # то выходим, дальше не продолжаем
+        order_ids = set()  # Номера активных заявок на бирже
+        stop_order_ids = set()  # Номера активных стоп заявок на бирже
+        for account in self.store.provider.accounts:  # Активные заявки получаем одним проходом по всем счетам
+            orders = self.store.call_function(self.store.provider.stub_orders, 'GetOrders', GetOrdersRequest(account_id=account.id), self.store.priority_portfolio)  # Активные заявки по счету
+            stop_orders = self.store.call_function(self.store.provider.stub_stop_orders, 'GetStopOrders', GetStopOrdersRequest(account_id=account.id), self.store.priority_portfolio)  # Активные стоп заявки по счету
+            if not orders or not stop_orders:  # Если активные заявки не получены
+                self.logger.warning('Ошибка получения активных заявок. Заявки из журнала не восстановлены. Заявки остаются в журнале')
+                carried = {entry['ref']: entry for entry in journal['orders']}  # Все заявки журнала
+                self.journal_entries = [self.get_carried_entry(entry, carried, {}) for entry in carried.values()]  # переносим в новый журнал
+                return  # Выходим, дальше не продолжаем
+            order_ids.update(order.order_id for order in orders.orders)
+            stop_order_ids.update(stop_order.stop_order_id for stop_order in stop_orders.stop_orders)
+        datas = {(data.class_code, data.symbol): data for data in self.store.datas}  # Данные по тикерам
+        restored = {}  # Восстановленные заявки по номерам из журнала
+        carried = {}  # Перенесенные заявки по номерам из журнала
+        children = []  # Дочерние заявки исполненных родительских заявок, которые нужно поставить на биржу
+        for entry in journal['orders']:  # Пробегаемся по всем заявкам журнала
+            class_code, symbol = entry['dataname'].split('.', 1)  # Код режима торгов и тикер
+            data = datas.get((class_code, symbol))  # Данные тикера
+            active = entry['order_id'] in order_ids or entry['stop_order_id'] in stop_order_ids  # Заявка активна на бирже
+            if data is None or entry['parent'] in carried:  # Если тикера нет в данных или родительская заявка перенесена. Линии BackTrader переопределяют bool, поэтому сравниваем с None
+                if active or entry['status'] == Order.Created or entry['parent'] in carried or (not entry['transmit'] and not entry['parent']):  # Если заявка на бирже, не отправлялась, или входит в группу родительской/дочерних заявок
+                    self.logger.warning(f'Заявка {entry["ref"]} по тикеру {entry["dataname"]} не восстановлена. Тикера или родительской заявки нет в данных. Заявка остается в журнале')
+                    carried[entry['ref']] = entry  # то переносим ее в журнал
+                else:  # Если заявки на бирже уже нет
+                    self.logger.info(f'Заявки {entry["ref"]} по тикеру {entry["dataname"]} нет на бирже')
+                continue  # Переходим к следующей заявке
+            parent = restored.get(entry['parent'])  # Родительская заявка
+            filled = False  # Заявка исполнена, пока нас не было
+            if entry['status'] == Order.Created:  # Если заявка не была отправлена на биржу
+                if entry['parent'] and not parent:  # Если ее родительская заявка не восстановлена
+                    continue  # то и дочернюю заявку не восстанавливаем
+            elif not active:  # Если заявки на бирже уже нет
+                if not entry['transmit'] and not entry['parent']:  # Для родительской заявки
+                    if entry['order_id']:  # Если это рыночная или лимитная заявка
+                        filled = self.get_execution_report_status(entry['account'], entry['order_id']) == EXECUTION_REPORT_STATUS_FILL  # то проверяем, исполнена ли она
+                    else:  # Для стоп заявки статус исполнения не получить
+                        self.logger.warning(f'Родительской стоп заявки {entry["ref"]} по тикеру {entry["dataname"]} нет на бирже. Исполнение не проверяется. Дочерние заявки не восстановлены')
+                        continue  # Переходим к следующей заявке
+                if not filled:  # Если заявка снята/отклонена
+                    self.logger.info(f'Заявки {entry["ref"]} по тикеру {entry["dataname"]} нет на бирже')
+                    continue  # то ее не восстанавливаем
+            order_cls = BuyOrder if entry['buy'] else SellOrder  # Заявка на покупку/продажу
+            order = order_cls(owner=None, data=data, size=entry['size'], price=entry['price'], pricelimit=entry['pricelimit'], exectype=entry['exectype'],
+                              parent=parent, transmit=entry['transmit'], simulated=True)  # Заявка без ТС. Бар по тикеру еще нет, поэтому simulated
+            order.addcomminfo(self.getcommissioninfo(data))  # По тикеру выставляем комиссии в заявку
+            order.addinfo(account=entry['account'])  # Торговый счет
+            if entry['order_id']:  # Для рыночной и лимитной заявки
+                order.addinfo(order_id=entry['order_id'])  # номер заявки
+            if entry['stop_order_id']:  # Для стоп и стоп-лимитной заявки
+                order.addinfo(stop_order_id=entry['stop_order_id'])  # уникальный идентификатор стоп-заявки
+            if filled:  # Если родительская заявка исполнена
+                order.completed()  # то заявка полностью исполнена
+            elif active:  # Если заявка активна на бирже
+                order.submit(self)  # Заявка отправлена на биржу
+                order.accept(self)  # Заявка принята на бирже
+                self.orders[order.ref] = order  # Сохраняем заявку в списке заявок, отправленных на биржу
+            elif parent and parent.status == Order.Completed:  # Если дочерняя заявка исполненной родительской заявки
+                children.append(order)  # то ставим ее в очередь на биржу
+            restored[entry['ref']] = order  # Заявка восстановлена
+            if not entry['transmit'] or parent:  # Для родительской/дочерних заявок
+                self.pcs[parent.ref if parent else order.ref].append(order)  # добавляем заявку в очередь родительской/дочерних заявок
+        for entry in journal['orders']:  # Связанные заявки восстанавливаем после всех заявок
+            if entry['oco'] in restored and entry['ref'] in restored:  # Если обе связанные заявки восстановлены
+                self.ocos[restored[entry['ref']].ref] = restored[entry['oco']].ref  # то восстанавливаем связь
+        self.journal_entries = [self.get_carried_entry(entry, carried, restored) for entry in carried.values()]  # Перенесенные заявки сохраним в журнал
+        self.logger.info(f'Из журнала восстановлено заявок: {len(restored)}, перенесено: {len(carried)}')
+        for child in children:  # Пробегаемся по всем дочерним заявкам исполненных родительских заявок
+            self.place_order(child)  # Отправляем дочернюю заявку на биржу
+        self.save_journal()  # Сохраняем журнал после сверки
+
+    @staticmethod
+    def get_carried_entry(entry, carried, restored) -> dict:
+        """Заявка журнала для переноса в новый журнал
+        Номера перенесенных заявок делаем отрицательными, чтобы они не совпали с номерами заявок этого запуска
+
+        :param dict entry: Заявка журнала
+        :param dict carried: Перенесенные заявки по номерам из журнала
+        :param dict restored: Восстановленные заявки по номерам из журнала
+        :return: Заявка для нового журнала
+        """
+        def get_ref(ref):
+            """Номер заявки в новом журнале"""
+            if ref in carried:  # Если заявка перенесена
+                return -abs(ref)  # то номер отрицательный
+            if ref in restored:  # Если заявка восстановлена
+                return restored[ref].ref  # то номер заявки этого запуска
+            return None  # Заявки больше нет
+
+        return dict(entry, ref=get_ref(entry['ref']), oco=get_ref(entry['oco']), parent=get_ref(entry['parent']))
+
+    def get_execution_report_status(self, account_id, order_id):
+        """Статус заявки на бирже
+
+        :param str account_id: Торговый счет
+        :param str order_id: Номер заявки на бирже
+        :return: Статус заявки или None, если статус не получен
+        """
+        response = self.store.call_function(self.store.provider.stub_orders, 'GetOrderState', GetOrderStateRequest(account_id=account_id, order_id=order_id), self.store.priority_portfolio)  # Состояние заявки
+        return response.execution_report_status if response else None
@@ -1,10 +1,17 @@
 import logging  # Будем вести лог
+from collections import deque  # Исторические бары берем с начала и ограничиваем окном
 from datetime import datetime, timezone, timedelta, time, UTC
 from time import sleep
 from uuid import uuid4  # Номера расписаний должны быть уникальными во времени и пространстве
-from threading import Thread, Event  # Поток и событие остановки потока получения новых бар по расписанию биржи
 import os.path
 import csv
+import json  # Индекс пропусков храним в формате JSON
+from heapq import merge  # Бары пропусков вставляем в файл истории при последовательном чтении
+from itertools import chain, islice
+import gzip  # Сжатие файла истории в формате gzip
+import bz2  # Сжатие файла истории в формате bzip2
+import lzma  # Сжатие файла истории в формате xz
+import zlib  # Распаковка gzip по блокам при восстановлении файла истории
 
 from backtrader.feed import AbstractDataBase
 from backtrader.utils.py3 import with_metaclass
@@ -29,10 +36,20 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
         ('four_price_doji', False),  # False - не пропускать дожи 4-х цен, True - пропускать
         ('schedule', None),  # Расписание работы биржи
         ('live_bars', False),  # False - только история, True - история и новые бары
+        ('repair_gaps', False),  # False - не искать пропуски в файле истории, True - искать пропуски и загружать пропущенные бары
+        ('max_gap', None),  # Максимальный промежуток без бар внутри торговой сессии (timedelta). None - пропуском считаются только торговые дни без бар
+        ('lookback', None),  # Окно истории: None - вся история, int - последние N бар, timedelta - бары за последний период. Буфер линий ограничивается через Cerebro(exactbars=...)
+        ('file_compression', None),  # Сжатие файла истории: None - без сжатия, 'gz' - gzip, 'bz2' - bzip2, 'xz' - LZMA
     )
     datapath = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Data', 'Tinkoff', '')  # Путь сохранения файла истории
     delimiter = '\t'  # Разделитель значений в файле истории. По умолчанию табуляция
     dt_format = '%d.%m.%Y %H:%M'  # Формат представления даты и времени в файле истории. По умолчанию русский формат
+    file_openers = {None: open, 'gz': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}  # Функции открытия файла истории по типу сжатия
+    file_decompressors = {'gz': lambda: zlib.decompressobj(zlib.MAX_WBITS | 16), 'bz2': bz2.BZ2Decompressor, 'xz': lzma.LZMADecompressor}  # Распаковщики одного блока сжатого файла по типу сжатия
+    filter_chunk_bars = 10000  # Кол-во бар из файла, которые проверяем фильтрами за один замер
+    recover_block_size = 65536  # Размер части сжатого файла истории в байтах, которые распаковываем при восстановлении
+    file_buffer_bars = 60  # Кол-во новых бар, которые копим перед записью в сжатый файл. Каждая запись в сжатый файл - новый блок со своим заголовком
+    tail_block_size = 65536  # Размер блока в байтах для чтения конца файла истории без сжатия при заданном окне истории
     sleep_time_sec = 1  # Время ожидания в секундах, если не пришел новый бар. Для снижения нагрузки/энергопотребления процессора
 
     def islive(self):
@@ -49,13 +66,22 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
         self.tf = self.bt_timeframe_to_tf(self.p.timeframe, self.p.compression)  # Конвертируем временной интервал из BackTrader для имени файла истории и расписания
         self.file = f'{self.class_code}.{self.symbol}_{self.tf}'  # Имя файла истории
         self.logger = logging.getLogger(f'TKData.{self.file}')  # Будем вести лог
-        self.file_name = f'{self.datapath}{self.file}.txt'  # Полное имя файла истории
-        si = self.store.provider.get_symbol_info(self.class_code, self.symbol)  # Спецификация тикера
+        if self.p.file_compression not in self.file_openers:  # Если тип сжатия файла истории не поддерживается
+            raise NotImplementedError  # то с ним не работаем
+        self.file_name = f'{self.datapath}{self.file}.txt' if not self.p.file_compression else f'{self.datapath}{self.file}.txt.{self.p.file_compression}'  # Полное имя файла истории. Для сжатого файла добавляем расширение типа сжатия
+        for phase in ('repair_gaps', 'get_bars_from_file', 'get_bars_from_history', 'get_history_bars', 'save_bars_to_file'):  # Пробегаемся по всем этапам запуска. Фильтры замеряем в сумме за этап, а не по каждому бару
+            setattr(self, phase, self.store.profiled(self.file, phase, getattr(self, phase)))  # Замеряем время выполнения этапа, если замеры ведутся в хранилище
+        with self.store.measure(self.file, 'get_symbol_info'):  # Замеряем получение спецификации тикера
+            si = self.store.get_symbol_info(self.class_code, self.symbol, self.store.priority_history)  # Спецификация тикера
         self.figi = si.figi  # Уникальный код тикера
         self.lot = si.lot  # Размер лота
-        self.history_bars = []  # Исторические бары после применения фильтров
+        self.history_bars = deque(maxlen=self.p.lookback if isinstance(self.p.lookback, int) else None)  # Исторические бары после применения фильтров. При окне в N бар старые бары вытесняются
+        self.gaps = []  # Индекс пропусков в файле истории
+        self.file_buffer = []  # Новые бары, еще не записанные в сжатый файл
+        self.gaps_file_name = f'{self.file_name}.gaps.json'  # Индекс пропусков храним рядом с файлом истории
+        self.prefetched = False  # Бары из файла и истории получены хранилищем до запуска данных
         self.guid = None  # Идентификатор подписки/расписания на историю цен
-        self.exit_event = Event()  # Определяем событие выхода из потока
+        self.fetch_time_sec = None  # Время получения последнего бара по расписанию в секундах от запроса
         self.dt_last_open = datetime.min  # Дата и время открытия последнего полученного бара
         self.last_bar_received = False  # Получен последний бар
         self.live_mode = False  # Режим получения бар. False = История, True = Новые бары
@@ -64,18 +90,21 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
         """Добавление хранилища Тинькофф в cerebro"""
         super(TKData, self).setenvironment(env)
         env.addstore(self.store)  # Добавление хранилища Тинькофф в cerebro
+        if not any(data is self for data in self.store.datas):  # Если данные еще не зарегистрированы в хранилище. Линии BackTrader переопределяют ==, поэтому сравниваем объекты
+            self.store.datas.append(self)  # то регистрируем их. Хранилище получит бары только по данным, добавленным в cerebro
 
     def start(self):
         super(TKData, self).start()
         self.put_notification(self.DELAYED)  # Отправляем уведомление об отправке исторических (не новых) баров
-        self.get_bars_from_file()  # Получаем бары из файла
-        self.get_bars_from_history()  # Получаем бары из истории
+        if not self.prefetched:  # Если бары не были получены хранилищем
+            self.prefetch()  # то получаем их сами
+        self.prefetched = False  # При следующем запуске бары нужно будет получить снова
         if len(self.history_bars) > 0:  # Если был получен хотя бы 1 бар
             self.put_notification(self.CONNECTED)  # то отправляем уведомление о подключении и начале получения исторических баров
         if self.p.live_bars:  # Если получаем историю и новые бары
             if self.p.schedule:  # Если получаем новые бары по расписанию
                 self.guid = str(uuid4())  # guid расписания
-                Thread(target=self.stream_bars).start()  # Создаем и запускаем получение новых бар по расписанию в потоке
+                self.store.add_schedule_data(self)  # Бары по расписанию получаем в хранилище вместе с другими тикерами с тем же расписанием и временнЫм интервалом
             else:  # Если получаем новые бары по подписке
                 self.guid = (self.figi, self.tinkoff_subscription_timeframe)  # guid подписки
                 self.logger.debug('Запуск подписки на новые бары')
@@ -88,7 +117,7 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
     def _load(self):
         """Загрузка бара из истории или нового бара"""
         if len(self.history_bars) > 0:  # Если есть исторические данные
-            bar = self.history_bars.pop(0)  # Берем и удаляем первый бар из хранилища. С ним будем работать
+            bar = self.history_bars.popleft()  # Берем и удаляем первый бар из хранилища. С ним будем работать
         elif not self.p.live_bars:  # Если получаем только историю (self.history_bars) и исторических данных нет / все исторические данные получены
             self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения исторических бар
             self.logger.debug('Бары из файла/истории отправлены в ТС. Новые бары получать не нужно. Выход')
@@ -130,7 +159,7 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
         super(TKData, self).stop()
         if self.p.live_bars:  # Если была подписка/расписание
             if self.p.schedule:  # Если получаем новые бары по расписанию
-                self.exit_event.set()  # то отменяем расписание
+                self.store.remove_schedule_data(self)  # то отменяем расписание
             else:  # Если получаем новые бары по подписке
                 self.logger.info('Отмена подписки на новые бары')
                 self.store.provider.subscription_marketdata_queue.put(  # Ставим в буфер команд подписки на биржевую информацию
@@ -139,83 +168,408 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
                         instruments=(CandleInstrument(interval=self.tinkoff_subscription_timeframe, instrument_id=self.figi),),  # на тикер по временному интервалу
                         waiting_close=True)))  # по закрытию бара
             self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения новых бар
+        self.flush_file_buffer()  # Записываем в файл накопленные новые бары
+        self.store.datas = [data for data in self.store.datas if data is not self]  # Удаляем данные из хранилища, чтобы при следующем запуске не получать по ним бары. Линии BackTrader переопределяют ==, поэтому сравниваем объекты
         self.store.DataCls = None  # Удаляем класс данных в хранилище
 
     # Получение/сохранение бар
 
+    def prefetch(self) -> None:
+        """Получение бар из файла и истории. Хранилище вызывает для всех данных параллельно до их запуска"""
+        if self.p.repair_gaps:  # Если нужно заполнить пропуски в файле истории
+            self.repair_gaps()  # то заполняем их до получения бар из файла
+        self.get_bars_from_file()  # Получаем бары из файла
+        self.get_bars_from_history()  # Получаем бары из истории
+        self.prefetched = True  # Бары получены
+
     def get_bars_from_file(self) -> None:
         """Получение бар из файла"""
         if not os.path.isfile(self.file_name):  # Если файл не существует
             return  # то выходим, дальше не продолжаем
         self.logger.debug(f'Получение бар из файла {self.file_name}')
-        with open(self.file_name) as file:  # Открываем файл на последовательное чтение
-            reader = csv.reader(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-            next(reader, None)  # Пропускаем первую строку с заголовками
-            for csv_row in reader:  # Последовательно получаем все строки файла
-                bar = dict(datetime=datetime.strptime(csv_row[0], self.dt_format),
-                           open=float(csv_row[1]), high=float(csv_row[2]), low=float(csv_row[3]), close=float(csv_row[4]),
-                           volume=int(csv_row[5]))  # Бар из файла
-                if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
-                    self.history_bars.append(bar)  # то добавляем бар
+        bars = self.read_tail_bars_from_file() if self.p.lookback and not self.p.file_compression else self.read_bars_from_file()  # Из файла без сжатия при заданном окне читаем только конец
+        bars = iter(bars)  # Бары из файла получаем последовательно
+        while chunk := list(islice(bars, self.filter_chunk_bars)):  # Бары проверяем частями, чтобы замерять фильтры в сумме, а не по каждому бару
+            for bar in self.filter_bars(chunk):  # Пробегаемся по всем барам, соответствующим всем условиям выборки
+                self.history_bars.append(bar)  # Добавляем бар
+                self.trim_history_bars()  # и убираем бары за пределами окна истории
+        self.store.add_stat(self.file, 'get_bars_from_file', len(self.history_bars), os.path.getsize(self.file_name))  # Кол-во бар и байт файла в замеры
         if len(self.history_bars) > 0:  # Если были получены бары из файла
             self.logger.debug(f'Получено бар из файла: {len(self.history_bars)} с {self.history_bars[0]["datetime"].strftime(self.dt_format)} по {self.history_bars[-1]["datetime"].strftime(self.dt_format)}')
         else:  # Бары из файла не получены
             self.logger.debug('Из файла новых бар не получено')
 
+    def read_bars_from_file(self):
+        """Последовательное чтение всех бар из файла без применения фильтров
+        Если последний блок сжатого файла оборван при сбое, то файл восстанавливаем по барам до обрыва
+        """
+        bars_read = 0  # Кол-во прочитанных бар
+        try:
+            with self.open_file('r') as file:  # Открываем файл на последовательное чтение. Сжатый файл распаковывается по мере чтения
+                reader = csv.reader(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+                next(reader, None)  # Пропускаем первую строку с заголовками
+                for csv_row in reader:  # Последовательно получаем все строки файла
+                    yield self.csv_row_to_bar(csv_row)
+                    bars_read += 1
+        except (EOFError, OSError, lzma.LZMAError, zlib.error) as e:  # Если сжатый файл оборван или поврежден
+            if not self.p.file_compression or not self.is_file_corrupted_error(e):  # Файл без сжатия не восстанавливаем. Ошибки ввода/вывода не являются повреждением файла
+                raise
+            self.logger.warning(f'Файл {self.file_name} поврежден после бара {bars_read}: {e!r}. Восстанавливаем бары до повреждения')
+            self.recover_file()  # Восстанавливаем файл
+            yield from islice(self.read_bars_from_file(), bars_read, None)  # Отдаем восстановленные бары, которые еще не были прочитаны
+
+    @staticmethod
+    def is_file_corrupted_error(e) -> bool:
+        """Ошибка повреждения сжатого файла, а не ввода/вывода. bz2 при повреждении выдает OSError без кода ошибки
+
+        :param Exception e: Ошибка чтения файла
+        """
+        return isinstance(e, (EOFError, gzip.BadGzipFile, lzma.LZMAError, zlib.error)) or isinstance(e, OSError) and e.errno is None
+
+    def recover_file(self) -> None:
+        """Восстановление сжатого файла истории, конец которого оборван или поврежден
+        Файл последовательно распаковываем во временный файл до повреждения и заменяем им файл истории. Потерянные бары будут получены из истории
+        """
+        tmp_file_name = f'{self.file_name}.tmp'  # Файл истории записываем во временный файл, чтобы не потерять историю при сбое
+        lines = 0  # Кол-во восстановленных строк
+        with open(self.file_name, 'rb') as file, self.open_file('w', tmp_file_name) as tmp_file:  # Сжатый файл читаем без распаковки, временный файл создаем со сжатием
+            decompressor = self.file_decompressors[self.p.file_compression]()  # Распаковщик блока. Каждое добавление в сжатый файл - отдельный блок
+            tail = b''  # Неполная последняя строка
+            while data := file.read(self.recover_block_size):  # Читаем сжатый файл частями
+                try:
+                    while data:  # Пока в части есть сжатые данные
+                        text = tail + decompressor.decompress(data)  # Распаковываем часть. Из оборванного блока получаем все, что успели распаковать
+                        *complete, tail = text.split(b'\n')  # Полные строки и неполная последняя строка
+                        for line in complete:  # Пробегаемся по всем полным строкам
+                            tmp_file.write(line.decode() + '\n')  # Записываем строку. Перевод строки CSV \r\n сохраняется
+                        lines += len(complete)
+                        data = b''  # Часть распакована
+                        if decompressor.eof:  # Если блок закончился
+                            data = decompressor.unused_data  # то в части могут быть следующие блоки
+                            decompressor = self.file_decompressors[self.p.file_compression]()  # Распаковщик следующего блока
+                except (EOFError, OSError, lzma.LZMAError, zlib.error, UnicodeDecodeError):  # Если дошли до повреждения
+                    break  # то дальше не читаем. Неполную последнюю строку не восстанавливаем
+        os.replace(tmp_file_name, self.file_name)  # Заменяем файл истории
+        self.logger.warning(f'Файл {self.file_name} восстановлен. Бар: {max(lines - 1, 0)}')
+
+    def read_tail_bars_from_file(self) -> list:
+        """Чтение бар из конца файла без сжатия в пределах окна истории
+        Файл читаем блоками с конца, пока после применения фильтров (диапазон дат, сессия, дожи) не наберем нужное кол-во бар
+        или не дойдем до бара раньше начала периода. Окно отсчитываем от последнего бара, прошедшего фильтры, в т.ч. todate
+
+        :return: Бары из конца файла без применения фильтров. Фильтры применяются при получении бар из файла
+        """
+        dt_last_open = self.dt_last_open  # Фильтры запоминают дату и время последнего бара. Восстановим их после проверки
+        with open(self.file_name, 'rb') as file:  # Открываем файл на чтение в двоичном режиме, чтобы перемещаться по нему
+            position = file.seek(0, os.SEEK_END)  # Переходим в конец файла
+            block_size = self.tail_block_size  # Размер блока. Увеличиваем его, если бар, прошедших фильтры, не хватает
+            data = b''  # Прочитанный конец файла
+            bars = []  # Бары из полных строк прочитанного конца файла
+            while position > 0:  # Пока не дошли до начала файла
+                block_size = min(block_size, position)  # Размер блока
+                position -= block_size  # Смещаемся на блок назад
+                file.seek(position)  # Переходим к началу блока
+                data = file.read(block_size) + data  # Добавляем блок к прочитанному концу файла
+                block_size *= 2  # Следующий блок читаем больше, чтобы не проверять конец файла слишком много раз
+                lines = data.decode().splitlines()[1:]  # Строки прочитанного конца файла без неполной первой строки или заголовка
+                bars = [self.csv_row_to_bar(line.split(self.delimiter)) for line in lines if line]  # Бары без применения фильтров
+                self.dt_last_open = dt_last_open  # Проверяем бары с того же состояния, что и при получении бар из файла
+                valid_bars = self.filter_bars(bars)  # Бары, прошедшие фильтры
+                if len(valid_bars) == 0:  # Если бар, прошедших фильтры, еще нет
+                    continue  # то читаем следующий блок
+                if isinstance(self.p.lookback, int):  # Если окно задано в барах
+                    if len(valid_bars) >= self.p.lookback:  # Если набрали нужное кол-во бар
+                        break  # то дальше не читаем
+                elif bars[0]['datetime'] < valid_bars[-1]['datetime'] - self.p.lookback:  # Если окно задано периодом, и дошли до бара раньше начала периода
+                    break  # то дальше не читаем
+        self.dt_last_open = dt_last_open  # Восстанавливаем состояние фильтров
+        return bars
+
+    def csv_row_to_bar(self, csv_row) -> dict:
+        """Бар из строки файла"""
+        return dict(datetime=datetime.strptime(csv_row[0], self.dt_format),
+                    open=float(csv_row[1]), high=float(csv_row[2]), low=float(csv_row[3]), close=float(csv_row[4]),
+                    volume=int(csv_row[5]))  # Бар из файла
+
+    def filter_bars(self, bars) -> list:
+        """Бары, соответствующие всем условиям выборки. Время и процессорное время фильтров замеряем в сумме за все бары, а не по каждому бару
+
+        :param list bars: Бары, упорядоченные по дате и времени открытия
+        :return: Бары, прошедшие фильтры
+        """
+        with self.store.measure(self.file, 'is_bar_valid'):  # Замеряем проверку всех бар
+            valid_bars = [bar for bar in bars if self.is_bar_valid(bar)]
+        self.store.add_stat(self.file, 'is_bar_valid', len(bars))  # Кол-во проверенных бар в замеры
+        return valid_bars
+
+    def trim_history_bars(self) -> None:
+        """Удаление исторических бар за пределами окна истории, заданного периодом. Окно в N бар соблюдается самой очередью"""
+        if not self.p.lookback or isinstance(self.p.lookback, int):  # Если окно не задано или задано в барах
+            return  # то выходим, дальше не продолжаем
+        dt_from = self.history_bars[-1]['datetime'] - self.p.lookback  # Дата и время начала окна истории
+        while self.history_bars[0]['datetime'] < dt_from:  # Пока первый бар раньше начала окна
+            self.history_bars.popleft()  # убираем его
+
     def get_bars_from_history(self) -> None:
         """Получение бар из истории"""
-        file_history_bars_len = len(self.history_bars)  # Кол-во полученных бар из файла для лога
+        history_dates = []  # Дата и время первого и последнего бара из истории для лога
+        history_bars_len = 0  # Кол-во полученных бар из истории для лога
         if self.dt_last_open > datetime.min:  # Если в файле были бары
             last_date = self.dt_last_open  # Дата и время последнего бара из файла по МСК
             next_bar_open_utc = self.store.provider.msk_to_utc_datetime(last_date + timedelta(minutes=1), True) if self.intraday else \
                 last_date.replace(tzinfo=timezone.utc) + timedelta(days=1)  # Смещаем время на возможный следующий бар по UTC
         else:  # Если в файле не было баров
-            si = self.store.provider.get_symbol_info(self.class_code, self.symbol)  # Информация о тикере
+            si = self.store.get_symbol_info(self.class_code, self.symbol, self.store.priority_history)  # Информация о тикере
             next_bar_open_utc = datetime.fromtimestamp(si.first_1min_candle_date.seconds, timezone.utc) if self.intraday else \
                 datetime.fromtimestamp(si.first_1day_candle_date.seconds, timezone.utc)  # Дата/время первого минутного/дневного бара истории
+        file_size = os.path.getsize(self.file_name) if os.path.isfile(self.file_name) else 0  # Размер файла до получения бар из истории
         todate_utc = datetime.now(UTC)  # Будем получать бары до текущей даты и времени UTC
         _, td = self.store.provider.tinkoff_timeframe_to_timeframe(self.tinkoff_timeframe)  # Максимальный период запроса
         while True:  # Будем получать бары пока не получим все
-            request = GetCandlesRequest(instrument_id=self.figi, interval=self.tinkoff_timeframe)  # Запрос на получение бар
-            from_ = getattr(request, 'from')  # т.к. from - ключевое слово в Python, то получаем атрибут from из атрибута интервала
-            to_ = getattr(request, 'to')  # Аналогично будем работать с атрибутом to для единообразия
-            from_.seconds = Timestamp(seconds=int(next_bar_open_utc.timestamp())).seconds  # Дата и время начала интервала UTC
             todate_min_utc = min(todate_utc, next_bar_open_utc + td)  # До какой даты можем делать запрос
-            to_.seconds = Timestamp(seconds=int(todate_min_utc.timestamp())).seconds  # Дата и время окончания интервала UTC
-            self.logger.debug(f'Получение бар из истории с {next_bar_open_utc} по {todate_min_utc}')
-            response = self.store.provider.call_function(self.store.provider.stub_marketdata.GetCandles, request)  # Получаем ответ на запрос бар
-            if not response:  # Если в ответ ничего не получили
-                self.logger.warning('Ошибка запроса бар из истории')
-                return  # то выходим, дальше не продолжаем
-            response_dict = MessageToDict(response, always_print_fields_with_no_presence=True)  # Переводим в словарь из JSON
-            if 'candles' not in response_dict:  # Если бар нет в словаре
-                self.logger.error(f'Бар (candles) нет в словаре {response_dict}')
-                return  # то выходим, дальше не продолжаем
-            new_bars_dict = response_dict['candles']  # Получаем все бары из Tinfoff
-            if len(new_bars_dict) > 0:  # Если пришли новые бары
-                first_bar_open_dt = self.get_bar_open_date_time(new_bars_dict[0])  # Дату и время первого полученного бара переводим из UTC в МСК
-                last_bar_open_dt = self.get_bar_open_date_time(new_bars_dict[-1])  # Дату и время последнего полученного бара переводим из UTC в МСК
-                self.logger.debug(f'Получены бары с {first_bar_open_dt} по {last_bar_open_dt}')
-                for new_bar in new_bars_dict:  # Пробегаемся по всем полученным барам
-                    if not new_bar['isComplete']:  # Если добрались до незавершенного бара
-                        break  # то это последний бар, больше бары обрабатывать не будем
-                    bar = dict(datetime=self.get_bar_open_date_time(new_bar),
-                               open=self.store.provider.dict_quotation_to_float(new_bar['open']),
-                               high=self.store.provider.dict_quotation_to_float(new_bar['high']),
-                               low=self.store.provider.dict_quotation_to_float(new_bar['low']),
-                               close=self.store.provider.dict_quotation_to_float(new_bar['close']),
-                               volume=int(new_bar['volume']) * self.lot)  # Бар из истории
-                    if self.is_bar_valid(bar):  # Если исторический бар соответствует всем условиям выборки
-                        self.history_bars.append(bar)  # то добавляем бар
-                        self.save_bar_to_file(bar)  # и сохраняем бар в файл
+            new_bars = self.get_history_bars(next_bar_open_utc, todate_min_utc)  # Завершенные бары из истории за интервал
+            if new_bars is None:  # Если при запросе бар произошла ошибка
+                break  # то дальше бары не получаем
+            bars = self.filter_bars(new_bars)  # Исторические бары, соответствующие всем условиям выборки. Их будем сохранять в файл
+            for bar in bars:  # Пробегаемся по всем барам, прошедшим фильтры
+                self.history_bars.append(bar)  # Добавляем бар
+                self.trim_history_bars()  # и убираем бары за пределами окна истории
+            if len(bars) > 0:  # Если были получены бары
+                history_dates = [history_dates[0] if history_dates else bars[0]['datetime'], bars[-1]['datetime']]  # то запоминаем дату и время первого и последнего бара
+                history_bars_len += len(bars)  # и увеличиваем кол-во бар
+            self.save_bars_to_file(bars)  # Сохраняем все бары запроса в файл за один раз. Для сжатого файла это один блок
             next_bar_open_utc = todate_min_utc + timedelta(minutes=1) if self.intraday else todate_min_utc + timedelta(days=1)  # Смещаем время на возможный следующий бар UTC
             if next_bar_open_utc > todate_utc:  # Если пройден весь интервал
                 break  # то выходим из цикла получения бар
-        if len(self.history_bars) - file_history_bars_len > 0:  # Если получены бары из истории
-            self.logger.debug(f'Получено бар из истории: {len(self.history_bars) - file_history_bars_len} с {self.history_bars[file_history_bars_len]["datetime"].strftime(self.dt_format)} по {self.history_bars[-1]["datetime"].strftime(self.dt_format)}')
+        self.store.add_stat(self.file, 'get_bars_from_history', history_bars_len, (os.path.getsize(self.file_name) if os.path.isfile(self.file_name) else 0) - file_size)  # Кол-во бар и байт, записанных в файл, в замеры
+        if history_bars_len > 0:  # Если получены бары из истории
+            self.logger.debug(f'Получено бар из истории: {history_bars_len} с {history_dates[0].strftime(self.dt_format)} по {history_dates[1].strftime(self.dt_format)}')
         else:  # Бары из истории не получены
             self.logger.debug('Из истории новых бар не получено')
 
+    def get_history_bars(self, from_utc, to_utc):
+        """Получение завершенных бар из истории за интервал без применения фильтров. Интервал не должен превышать максимальный период запроса
+
+        :param datetime from_utc: Дата и время начала интервала UTC
+        :param datetime to_utc: Дата и время окончания интервала UTC
+        :return: Список бар или None, если при запросе произошла ошибка
+        """
+        request = GetCandlesRequest(instrument_id=self.figi, interval=self.tinkoff_timeframe)  # Запрос на получение бар
+        from_ = getattr(request, 'from')  # т.к. from - ключевое слово в Python, то получаем атрибут from из атрибута интервала
+        to_ = getattr(request, 'to')  # Аналогично будем работать с атрибутом to для единообразия
+        from_.seconds = Timestamp(seconds=int(from_utc.timestamp())).seconds  # Дата и время начала интервала UTC
+        to_.seconds = Timestamp(seconds=int(to_utc.timestamp())).seconds  # Дата и время окончания интервала UTC
+        self.logger.debug(f'Получение бар из истории с {from_utc} по {to_utc}')
+        response = self.store.call_function(self.store.provider.stub_marketdata, 'GetCandles', request, self.store.priority_history)  # Получаем ответ на запрос бар
+        if not response:  # Если в ответ ничего не получили
+            self.logger.warning('Ошибка запроса бар из истории')
+            return None  # то выходим, дальше не продолжаем
+        response_dict = MessageToDict(response, always_print_fields_with_no_presence=True)  # Переводим в словарь из JSON
+        if 'candles' not in response_dict:  # Если бар нет в словаре
+            self.logger.error(f'Бар (candles) нет в словаре {response_dict}')
+            return None  # то выходим, дальше не продолжаем
+        new_bars_dict = response_dict['candles']  # Получаем все бары из Tinfoff
+        self.store.add_stat(self.file, 'get_history_bars', len(new_bars_dict), response.ByteSize())  # Кол-во бар и байт ответа в замеры
+        bars = []  # Завершенные бары
+        if len(new_bars_dict) > 0:  # Если пришли новые бары
+            first_bar_open_dt = self.get_bar_open_date_time(new_bars_dict[0])  # Дату и время первого полученного бара переводим из UTC в МСК
+            last_bar_open_dt = self.get_bar_open_date_time(new_bars_dict[-1])  # Дату и время последнего полученного бара переводим из UTC в МСК
+            self.logger.debug(f'Получены бары с {first_bar_open_dt} по {last_bar_open_dt}')
+            for new_bar in new_bars_dict:  # Пробегаемся по всем полученным барам
+                if not new_bar['isComplete']:  # Если добрались до незавершенного бара
+                    break  # то это последний бар, больше бары обрабатывать не будем
+                bars.append(dict(datetime=self.get_bar_open_date_time(new_bar),
+                                 open=self.store.provider.dict_quotation_to_float(new_bar['open']),
+                                 high=self.store.provider.dict_quotation_to_float(new_bar['high']),
+                                 low=self.store.provider.dict_quotation_to_float(new_bar['low']),
+                                 close=self.store.provider.dict_quotation_to_float(new_bar['close']),
+                                 volume=int(new_bar['volume']) * self.lot))  # Бар из истории
+        return bars
+
+    def repair_gaps(self) -> None:
+        """Поиск пропусков в файле истории по расписанию торгов биржи и загрузка только пропущенных бар
+        Индекс пропусков хранится рядом с файлом истории. Проверяем только бары, добавленные после прошлой проверки,
+        и пропуски, которые не удалось запросить. Заполненные и подтвержденные пустыми пропуски повторно не запрашиваем
+        """
+        if not os.path.isfile(self.file_name) or self.p.timeframe not in (TimeFrame.Minutes, TimeFrame.Days):  # Если файл не существует, или для временнОго интервала торговые дни не определить
+            return  # то выходим, дальше не продолжаем
+        index = self.load_gaps_index()  # Индекс пропусков прошлой проверки
+        if index['size'] > os.path.getsize(self.file_name):  # Если файл стал меньше, чем при прошлой проверке (файл заменили)
+            self.logger.info(f'Файл {self.file_name} изменился. Индекс пропусков строится заново')
+            index = dict(scanned_to=None, size=0, gaps=[])  # то проверяем файл заново
+        scanned_to = index['scanned_to']  # Дата и время последнего проверенного бара
+        if scanned_to is None:  # Если файл еще не проверялся
+            bars = self.read_bars_from_file()  # то последовательно проверяем все бары из файла без применения фильтров
+        else:  # Если файл уже проверялся
+            bars = chain([dict(datetime=scanned_to)], self.read_new_bars_from_file(index['size'], scanned_to))  # то проверяем только новые бары, начиная с последнего проверенного
+        self.gaps = index['gaps']  # Индекс пропусков в файле истории
+        gaps, dt_last = self.get_gaps(bars)  # Новые пропуски и последний проверенный бар
+        scanned = gaps is not None  # Новые бары проверены по расписанию
+        if scanned:  # Если новые бары проверены
+            self.gaps.extend(dict(start=gap_start, end=gap_end, state='pending') for gap_start, gap_end in gaps)  # то добавляем новые пропуски
+            index['scanned_to'] = dt_last  # и запоминаем последний проверенный бар
+            index['size'] = os.path.getsize(self.file_name)  # и размер проверенного файла
+        else:  # Если расписание не получено
+            self.logger.warning('Новые бары не проверены. Проверим их при следующем запуске')
+        pending = [gap for gap in self.gaps if gap['state'] == 'pending']  # Пропуски, которые нужно заполнить
+        if len(pending) == 0:  # Если пропусков нет
+            self.logger.debug('Пропусков в файле истории нет')
+            self.save_gaps_index(index)  # Сохраняем индекс пропусков
+            return  # то выходим, дальше не продолжаем
+        self.logger.info(f'Найдено пропусков в файле истории: {len(pending)}')
+        _, td = self.store.provider.tinkoff_timeframe_to_timeframe(self.tinkoff_timeframe)  # Максимальный период запроса
+        new_bars = {}  # Бары, которыми будем заполнять пропуски, по дате и времени открытия
+        for gap in pending:  # Пробегаемся по всем пропускам
+            gap_start, gap_end = gap['start'], gap['end']  # Дата и время начала и окончания пропуска по МСК
+            from_utc = self.store.provider.msk_to_utc_datetime(gap_start, True) if self.intraday else gap_start.replace(tzinfo=timezone.utc)  # Дата и время начала пропуска UTC
+            to_utc = self.store.provider.msk_to_utc_datetime(gap_end, True) if self.intraday else gap_end.replace(tzinfo=timezone.utc)  # Дата и время окончания пропуска UTC
+            gap_bars = []  # Бары пропуска
+            while from_utc < to_utc:  # Пропуск может быть больше максимального периода запроса
+                todate_min_utc = min(to_utc, from_utc + td)  # До какой даты можем делать запрос
+                bars = self.get_history_bars(from_utc, todate_min_utc)  # Завершенные бары из истории за интервал
+                if bars is None:  # Если при запросе бар произошла ошибка
+                    break  # то этот пропуск не заполняем
+                gap_bars.extend(bar for bar in bars if gap_start <= bar['datetime'] < gap_end and not self.is_bar_skipped(bar))  # Берем только бары внутри пропуска, которые не отбрасываются фильтрами данных
+                from_utc = todate_min_utc  # Переходим к следующему интервалу пропуска
+            else:  # Если пропуск запрошен полностью
+                gap['state'] = 'repaired' if gap_bars else 'empty'  # то он заполнен или подтвержден пустым (бар нет или все отброшены фильтрами). Больше его не запрашиваем
+                new_bars.update((bar['datetime'], bar) for bar in gap_bars)
+        if len(new_bars) == 0:  # Если бары для заполнения пропусков не получены
+            self.logger.info('Бары для заполнения пропусков не получены')
+            self.save_gaps_index(index)  # Сохраняем индекс пропусков
+            return  # то выходим, дальше не продолжаем
+        self.logger.info(f'Пропуски заполнены барами: {len(new_bars)}. Перезапись файла {self.file_name}')
+        file_bars = (bar for bar in self.read_bars_from_file() if bar['datetime'] not in new_bars)  # Бары из файла читаем последовательно. Бары из пропусков их заменяют
+        tmp_file_name = f'{self.file_name}.tmp'  # Файл истории записываем во временный файл, чтобы не потерять историю при сбое
+        with self.open_file('w', tmp_file_name) as file:  # Создаем временный файл
+            writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
+            writer.writerow(next(iter(new_bars.values())).keys())  # Записываем заголовок в файл
+            for bar in merge(file_bars, sorted(new_bars.values(), key=lambda bar: bar['datetime']), key=lambda bar: bar['datetime']):  # Пробегаемся по всем барам в порядке даты и времени открытия
+                csv_row = bar.copy()  # Копируем бар для того, чтобы изменить формат даты
+                csv_row['datetime'] = csv_row['datetime'].strftime(self.dt_format)  # Приводим дату к формату файла
+                writer.writerow(csv_row.values())  # Записываем бар
+        os.replace(tmp_file_name, self.file_name)  # Заменяем файл истории
+        index['size'] = os.path.getsize(self.file_name) if scanned else 0  # Если новые бары не проверены, то при следующем запуске ищем их с начала файла по дате и времени
+        self.save_gaps_index(index)  # Сохраняем индекс пропусков
+
+    def read_new_bars_from_file(self, offset, dt_from):
+        """Последовательное чтение бар, добавленных в файл после прошлой проверки, без применения фильтров
+
+        :param int offset: Размер файла при прошлой проверке. 0 - читаем с начала файла
+        :param datetime dt_from: Дата и время последнего проверенного бара
+        """
+        if not self.p.file_compression and offset > 0:  # Файл без сжатия
+            with open(self.file_name, 'rb') as file:  # Открываем файл на чтение в двоичном режиме, чтобы перейти к концу прошлой проверки
+                file.seek(offset)  # Бары до конца прошлой проверки не читаем
+                for line in file:  # Последовательно получаем все новые строки
+                    line = line.decode().rstrip('\r\n')  # Строка без перевода строки
+                    if line:  # Если строка не пустая
+                        yield self.csv_row_to_bar(line.split(self.delimiter))
+        else:  # Сжатый файл можно читать только с начала
+            for bar in self.read_bars_from_file():  # Последовательно получаем бары из файла
+                if bar['datetime'] > dt_from:  # Если бар после последнего проверенного
+                    yield bar
+
+    def load_gaps_index(self) -> dict:
+        """Индекс пропусков файла истории. Если индекса нет, то пустой индекс
+
+        :return: Дата и время последнего проверенного бара, размер файла при проверке, пропуски с состоянием: pending - не заполнен, repaired - заполнен, empty - бар нет
+        """
+        if os.path.isfile(self.gaps_file_name):  # Если индекс есть
+            try:
+                with open(self.gaps_file_name) as file:  # Открываем индекс
+                    index = json.load(file)  # Читаем индекс
+                return dict(scanned_to=datetime.fromisoformat(index['scanned_to']) if index['scanned_to'] else None, size=index['size'],
+                            gaps=[dict(start=datetime.fromisoformat(gap['start']), end=datetime.fromisoformat(gap['end']), state=gap['state']) for gap in index['gaps']])
+            except (OSError, ValueError, KeyError) as e:  # Если индекс не прочитать
+                self.logger.warning(f'Ошибка чтения индекса пропусков {self.gaps_file_name}: {e}. Индекс строится заново')
+        return dict(scanned_to=None, size=0, gaps=[])
+
+    def save_gaps_index(self, index) -> None:
+        """Сохранение индекса пропусков файла истории
+
+        :param dict index: Индекс пропусков
+        """
+        index = dict(scanned_to=index['scanned_to'].isoformat() if index['scanned_to'] else None, size=index['size'],  # Размер файла после проверки
+                     gaps=[dict(start=gap['start'].isoformat(), end=gap['end'].isoformat(), state=gap['state']) for gap in index['gaps']])
+        tmp_file_name = f'{self.gaps_file_name}.tmp'  # Индекс записываем во временный файл, чтобы не потерять его при сбое
+        with open(tmp_file_name, 'w') as file:  # Создаем временный файл
+            json.dump(index, file, indent=1)  # Записываем индекс
+        os.replace(tmp_file_name, self.gaps_file_name)  # Заменяем индекс
+
+    def get_gaps(self, bars) -> tuple:
+        """Индекс пропусков в барах по расписанию торгов биржи. Бары читаются последовательно
+        Пропуском считается торговый день без бар. Для внутридневных бар еще и промежуток без бар внутри торговой сессии длиннее max_gap,
+        в т.ч. от начала сессии до первого бара и от последнего бара до окончания сессии. Сессия ограничивается sessionstart/sessionend данных
+
+        :param bars: Бары, упорядоченные по дате и времени открытия
+        :return: Список пропусков (дата и время начала, дата и время окончания) по МСК или None, если расписание не получено. Дата и время последнего бара
+        """
+        bars = iter(bars)  # Бары получаем по одному
+        bar = next(bars, None)  # Первый бар
+        if bar is None:  # Если бар нет
+            return [], None  # то пропусков нет
+        first_dt = dt_last = bar['datetime']  # Пропуски ищем только между первым и последним баром
+        gaps = []  # Список пропусков
+        for session in self.iter_trading_sessions(first_dt.date()):  # Пробегаемся по всем торговым сессиям
+            if session is None:  # Если расписание не получено
+                return None, dt_last  # то без расписания пропуски не ищем
+            session_start, session_end = session  # Дата и время начала и окончания сессии
+            if self.intraday:  # Для внутридневных бар
+                if self.p.sessionstart != time.min:  # Если задано время начала сессии данных
+                    session_start = max(session_start, datetime.combine(session_start.date(), self.p.sessionstart))  # то бары до него отбрасываются фильтрами
+                if self.p.sessionend != time(23, 59, 59, 999990):  # Если задано время окончания сессии данных
+                    session_end = min(session_end, datetime.combine(session_start.date(), self.p.sessionend))  # то бары после него отбрасываются фильтрами
+                while bar is not None and bar['datetime'] < session_start:  # Пропускаем бары до начала сессии
+                    dt_last = bar['datetime']
+                    bar = next(bars, None)  # Переходим к следующему бару
+                if bar is None:  # Если бары закончились
+                    break  # то после последнего бара пропуски не ищем
+                if session_end <= first_dt or session_start >= session_end:  # Если сессия до первого бара или сессия данных пустая
+                    continue  # то переходим к следующей сессии
+                dt_from = max(session_start, first_dt)  # С какого времени нет бар
+                session_bars = 0  # Кол-во бар в сессии
+                while bar is not None and bar['datetime'] < session_end:  # Пробегаемся по всем барам сессии
+                    dt_open = dt_last = bar['datetime']  # Дата и время открытия бара
+                    if self.p.max_gap and dt_open - dt_from > self.p.max_gap:  # Если промежуток без бар от начала сессии или внутри сессии больше допустимого
+                        gaps.append((dt_from, dt_open))  # то это пропуск
+                    dt_from = self.get_bar_close_date_time(dt_open)  # Следующий бар ожидаем с закрытия этого бара
+                    session_bars += 1  # Увеличиваем кол-во бар в сессии
+                    bar = next(bars, None)  # Переходим к следующему бару
+                if bar is None:  # Если бары закончились
+                    break  # то после последнего бара пропуски не ищем
+                if session_bars == 0:  # Если в сессии нет ни одного бара
+                    gaps.append((session_start, session_end))  # то вся сессия - пропуск
+                elif self.p.max_gap and session_end - dt_from > self.p.max_gap:  # Если промежуток без бар до окончания сессии больше допустимого
+                    gaps.append((dt_from, session_end))  # то это пропуск
+            else:  # Для дневных бар
+                day = session_start.date()  # Торговый день
+                while bar is not None and bar['datetime'].date() < day:  # Пропускаем бары до торгового дня
+                    dt_last = bar['datetime']
+                    bar = next(bars, None)  # Переходим к следующему бару
+                if bar is None:  # Если бары закончились
+                    break  # то после последнего бара пропуски не ищем
+                if day > first_dt.date() and bar['datetime'].date() != day:  # Если торговый день после первого бара, а бара за него нет
+                    gaps.append((datetime.combine(day, time.min), datetime.combine(day, time.min) + timedelta(days=1)))  # то весь день - пропуск
+        for bar in chain([bar] if bar is not None else [], bars):  # Если сессии закончились раньше бар
+            dt_last = bar['datetime']  # то последний бар берем без проверки
+        return gaps, dt_last
+
+    def iter_trading_sessions(self, from_date):
+        """Торговые сессии биржи тикера из расписания торгов по периодам до текущей даты. Расписание берется из кэша хранилища
+
+        :param date from_date: Дата начала
+        :return: Сессии (дата и время начала, дата и время окончания) по МСК. None, если расписание не получено
+        """
+        exchange = self.store.get_symbol_info(self.class_code, self.symbol, self.store.priority_history).exchange  # Биржа тикера
+        to_date = self.get_tinkoff_date_time_now().date()  # Расписание получаем до текущей даты
+        while from_date <= to_date:  # Расписание получаем периодами
+            sessions, from_date = self.store.get_trading_sessions(exchange, from_date, self.store.priority_history)  # Сессии периода и дата начала следующего периода
+            if sessions is None:  # Если расписание не получено
+                yield None  # то сообщаем об этом
+                return  # и выходим, дальше не продолжаем
+            yield from sessions
+
     def is_bar_valid(self, bar) -> bool:
         """Проверка бара на соответствие условиям выборки"""
         dt_open = bar['datetime']  # Дата и время открытия бара МСК
@@ -226,19 +580,10 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
             # self.logger.debug(f'Дата/время открытия бара {dt_open} за границами диапазона {self.p.fromdate} - {self.p.todate}')
             self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
             return False  # то бар не соответствует условиям выборки
-        if self.p.sessionstart != time.min and dt_open.time() < self.p.sessionstart:  # Если задано время начала сессии и открытие бара до этого времени
-            self.logger.debug(f'Дата/время открытия бара {dt_open} до начала торговой сессии {self.p.sessionstart}')
+        if self.is_bar_skipped(bar):  # Если бар отбрасывается фильтрами данных
             self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
             return False  # то бар не соответствует условиям выборки
         dt_close = self.get_bar_close_date_time(dt_open)  # Дата и время закрытия бара
-        if self.p.sessionend != time(23, 59, 59, 999990) and dt_close.time() > self.p.sessionend:  # Если задано время окончания сессии и закрытие бара после этого времени
-            self.logger.debug(f'Дата/время открытия бара {dt_open} после окончания торговой сессии {self.p.sessionend}')
-            self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
-            return False  # то бар не соответствует условиям выборки
-        if not self.p.four_price_doji and bar['high'] == bar['low']:  # Если не пропускаем дожи 4-х цен, но такой бар пришел
-            self.logger.debug(f'Бар {dt_open} - дожи 4-х цен')
-            self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
-            return False  # то бар не соответствует условиям выборки
         time_market_now = self.get_tinkoff_date_time_now()  # Текущее биржевое время
         if dt_close > time_market_now and time_market_now.time() < self.p.sessionend:  # Если время закрытия бара еще не наступило на бирже, и сессия еще не закончилась
             self.logger.debug(f'Дата/время {dt_close} закрытия бара на {dt_open} еще не наступило')
@@ -246,60 +591,97 @@ class TKData(with_metaclass(MetaTKData, AbstractDataBase)):
         self.dt_last_open = dt_open  # Запоминаем дату/время открытия пришедшего бара для будущих сравнений
         return True  # В остальных случаях бар соответствуем условиям выборки
 
-    def stream_bars(self) -> None:
-        """Поток получения новых бар по расписанию биржи"""
-        self.logger.debug('Запуск получения новых бар по расписанию')
-        while True:
-            market_datetime_now = self.p.schedule.utc_to_msk_datetime(datetime.now(UTC))  # Текущее время на бирже
-            trade_bar_open_datetime = self.p.schedule.trade_bar_open_datetime(market_datetime_now, self.tf)  # Дата и время открытия бара, который будем получать
-            trade_bar_request_datetime = self.p.schedule.trade_bar_request_datetime(market_datetime_now, self.tf)  # Дата и время запроса бара на бирже
-            sleep_time_secs = (trade_bar_request_datetime - market_datetime_now).total_seconds()  # Время ожидания в секундах
-            self.logger.debug(f'Получение новых бар с {trade_bar_open_datetime.strftime(self.dt_format)} по расписанию в {trade_bar_request_datetime.strftime(self.dt_format)}. Ожидание {sleep_time_secs} с')
-            exit_event_set = self.exit_event.wait(sleep_time_secs)  # Ждем нового бара или события выхода из потока
-            if exit_event_set:  # Если произошло событие выхода из потока
-                self.logger.warning('Отмена получения новых бар по расписанию')
-                return  # Выходим из потока, дальше не продолжаем
-            ts_from = Timestamp(seconds=self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_open_datetime))  # Дата и время открытия бара в Google Timestamp UTC
-            trade_bar_close_datetime = self.p.schedule.trade_bar_close_datetime(market_datetime_now, self.tf)  # Дата и время закрытия бара, который будем получать
-            ts_to = Timestamp(seconds=self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_close_datetime))  # Дата и время закрытия бара в Google Timestamp UTC
-            request = GetCandlesRequest(instrument_id=self.figi, to=ts_to, interval=self.tinkoff_timeframe)  # Запрос на получение бар
-            from_ = getattr(request, 'from')  # т.к. from - ключевое слово в Python, то получаем атрибут from из атрибута интервала
-            from_.seconds = ts_from.seconds  # Устанавливаем значение через кол-во секунд
-            response = self.store.provider.call_function(self.store.provider.stub_marketdata.GetCandles, request)  # Получаем ответ на запрос бар
-            if not response:  # Если в ответ ничего не получили
-                self.logger.warning('Ошибка запроса бар из истории по расписанию')
-                continue  # то будем получать следующий бар
-            response_dict = MessageToDict(response, always_print_fields_with_no_presence=True)  # Получаем бары, переводим в словарь/список
-            if 'candles' not in response_dict:  # Если бар нет в словаре
-                self.logger.warning(f'Бар (candles) нет в истории по расписанию {response_dict}')
-                continue  # то будем получать следующий бар
-            bars = response_dict['candles']  # Последний сформированный и текущий несформированный (если имеется) бары
-            if len(bars) == 0:  # Если новых бар нет
-                self.logger.warning('Новые бары по расписанию не получены')
-                continue  # Будем получать следующий бар
-            new_bar = bars[0]  # Получаем первый (завершенный) бар
-            bar = dict(datetime=self.get_bar_open_date_time(new_bar),
-                       open=self.store.provider.dict_quotation_to_float(new_bar['open']),
-                       high=self.store.provider.dict_quotation_to_float(new_bar['high']),
-                       low=self.store.provider.dict_quotation_to_float(new_bar['low']),
-                       close=self.store.provider.dict_quotation_to_float(new_bar['close']),
-                       volume=int(new_bar['volume']))
-            self.logger.debug('Получен бар по расписанию')
-            self.store.new_bars.append(dict(guid=(self.figi, self.tf), data=bar))  # Добавляем в хранилище новых бар
+    def is_bar_skipped(self, bar) -> bool:
+        """Бар отбрасывается фильтрами данных: время сессии, дожи 4-х цен. Такие бары не сохраняются в файл, поэтому их отсутствие не пропуск"""
+        dt_open = bar['datetime']  # Дата и время открытия бара МСК
+        if self.p.sessionstart != time.min and dt_open.time() < self.p.sessionstart:  # Если задано время начала сессии и открытие бара до этого времени
+            self.logger.debug(f'Дата/время открытия бара {dt_open} до начала торговой сессии {self.p.sessionstart}')
+            return True  # то бар отбрасывается
+        dt_close = self.get_bar_close_date_time(dt_open)  # Дата и время закрытия бара
+        if self.p.sessionend != time(23, 59, 59, 999990) and dt_close.time() > self.p.sessionend:  # Если задано время окончания сессии и закрытие бара после этого времени
+            self.logger.debug(f'Дата/время открытия бара {dt_open} после окончания торговой сессии {self.p.sessionend}')
+            return True  # то бар отбрасывается
+        if not self.p.four_price_doji and bar['high'] == bar['low']:  # Если не пропускаем дожи 4-х цен, но такой бар пришел
+            self.logger.debug(f'Бар {dt_open} - дожи 4-х цен')
+            return True  # то бар отбрасывается
+        return False  # Бар проходит фильтры данных
+
+    def get_schedule_bar(self, trade_bar_open_datetime, trade_bar_close_datetime):
+        """Получение нового бара по расписанию биржи
+
+        :param datetime trade_bar_open_datetime: Дата и время открытия бара по МСК
+        :param datetime trade_bar_close_datetime: Дата и время закрытия бара по МСК
+        :return: Бар или None, если бар не получен
+        """
+        ts_from = Timestamp(seconds=self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_open_datetime))  # Дата и время открытия бара в Google Timestamp UTC
+        ts_to = Timestamp(seconds=self.p.schedule.msk_datetime_to_utc_timestamp(trade_bar_close_datetime))  # Дата и время закрытия бара в Google Timestamp UTC
+        request = GetCandlesRequest(instrument_id=self.figi, to=ts_to, interval=self.tinkoff_timeframe)  # Запрос на получение бар
+        from_ = getattr(request, 'from')  # т.к. from - ключевое слово в Python, то получаем атрибут from из атрибута интервала
+        from_.seconds = ts_from.seconds  # Устанавливаем значение через кол-во секунд
+        response = self.store.call_function(self.store.provider.stub_marketdata, 'GetCandles', request, self.store.priority_new_bars)  # Получаем ответ на запрос бар
+        if not response:  # Если в ответ ничего не получили
+            self.logger.warning('Ошибка запроса бар из истории по расписанию')
+            return None  # то бар не получен
+        response_dict = MessageToDict(response, always_print_fields_with_no_presence=True)  # Получаем бары, переводим в словарь/список
+        if 'candles' not in response_dict:  # Если бар нет в словаре
+            self.logger.warning(f'Бар (candles) нет в истории по расписанию {response_dict}')
+            return None  # то бар не получен
+        bars = response_dict['candles']  # Последний сформированный и текущий несформированный (если имеется) бары
+        if len(bars) == 0:  # Если новых бар нет
+            self.logger.warning('Новые бары по расписанию не получены')
+            return None  # то бар не получен
+        new_bar = bars[0]  # Получаем первый (завершенный) бар
+        self.logger.debug('Получен бар по расписанию')
+        return dict(datetime=self.get_bar_open_date_time(new_bar),
+                    open=self.store.provider.dict_quotation_to_float(new_bar['open']),
+                    high=self.store.provider.dict_quotation_to_float(new_bar['high']),
+                    low=self.store.provider.dict_quotation_to_float(new_bar['low']),
+                    close=self.store.provider.dict_quotation_to_float(new_bar['close']),
+                    volume=int(new_bar['volume']))
 
     def save_bar_to_file(self, bar) -> None:
-        """Сохранение бара в конец файла"""
+        """Сохранение нового бара в конец файла
+        В сжатый файл новые бары записываем по file_buffer_bars за раз. При сбое не записанные бары будут получены из истории
+        """
+        if not self.p.file_compression:  # Если файл без сжатия
+            self.save_bars_to_file([bar])  # то сохраняем бар как список из одного бара
+            return  # Выходим, дальше не продолжаем
+        self.file_buffer.append(bar)  # Накапливаем новые бары
+        if len(self.file_buffer) >= self.file_buffer_bars:  # Если накопили достаточно
+            self.flush_file_buffer()  # то записываем их одним блоком
+
+    def flush_file_buffer(self) -> None:
+        """Запись накопленных новых бар в сжатый файл одним блоком"""
+        bars, self.file_buffer = self.file_buffer, []  # Забираем накопленные бары
+        self.save_bars_to_file(bars)  # Сохраняем их в конец файла
+
+    def save_bars_to_file(self, bars) -> None:
+        """Сохранение бар в конец файла"""
+        if len(bars) == 0:  # Если бар для сохранения нет
+            return  # то выходим, дальше не продолжаем
+        file_size = os.path.getsize(self.file_name) if os.path.isfile(self.file_name) else 0  # Размер файла до записи
         if not os.path.isfile(self.file_name):  # Существует ли файл
             self.logger.warning(f'Файл {self.file_name} не найден и будет создан')
-            with open(self.file_name, 'w', newline='') as file:  # Создаем файл
+            with self.open_file('w') as file:  # Создаем файл
                 writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-                writer.writerow(bar.keys())  # Записываем заголовок в файл
-        with open(self.file_name, 'a', newline='') as file:  # Открываем файл на добавление в конец. Ставим newline, чтобы в Windows не создавались пустые строки в файле
+                writer.writerow(bars[0].keys())  # Записываем заголовок в файл
+        with self.open_file('a') as file:  # Открываем файл на добавление в конец. Сжатый файл дописывается новым блоком
             writer = csv.writer(file, delimiter=self.delimiter)  # Данные в строке разделены табуляцией
-            csv_row = bar.copy()  # Копируем бар для того, чтобы изменить формат даты
-            csv_row['datetime'] = csv_row['datetime'].strftime(self.dt_format)  # Приводим дату к формату файла
-            writer.writerow(csv_row.values())  # Записываем бар в конец файла
-            self.logger.debug(f'В файл {self.file_name} записан бар на {csv_row["datetime"]}')
+            for bar in bars:  # Пробегаемся по всем барам
+                csv_row = bar.copy()  # Копируем бар для того, чтобы изменить формат даты
+                csv_row['datetime'] = csv_row['datetime'].strftime(self.dt_format)  # Приводим дату к формату файла
+                writer.writerow(csv_row.values())  # Записываем бар в конец файла
+        self.store.add_stat(self.file, 'save_bars_to_file', len(bars), os.path.getsize(self.file_name) - file_size)  # Кол-во бар и записанных байт в замеры
+        self.logger.debug(f'В файл {self.file_name} записано бар: {len(bars)} с {bars[0]["datetime"].strftime(self.dt_format)} по {bars[-1]["datetime"].strftime(self.dt_format)}')
+
+    def open_file(self, mode, file_name=None):
+        """Открытие файла истории в текстовом режиме с учетом типа сжатия
+
+        :param str mode: Режим открытия файла: 'r' - чтение, 'w' - создание, 'a' - добавление в конец
+        :param str file_name: Полное имя файла. По умолчанию, файл истории
+        :return: Файловый объект
+        """
+        return self.file_openers[self.p.file_compression](file_name or self.file_name, f'{mode}t', newline='')  # Ставим newline, чтобы в Windows не создавались пустые строки в файле
 
     # Функции
 
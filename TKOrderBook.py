@@ -0,0 +1,130 @@
+import logging  # Будем вести лог
+from array import array  # Снимки стакана храним в кольцевом буфере чисел, а не в объектах Python
+from datetime import datetime, UTC
+from time import sleep
+
+from backtrader.feed import AbstractDataBase
+from backtrader import date2num
+
+from BackTraderTinkoff import TKStore
+from TinkoffPy.grpc.marketdata_pb2 import OrderBook
+
+
+class TKOrderBook(AbstractDataBase):
+    """Стакан Тинькофф. В ТС подается последний снимок стакана. Промежуточные снимки доступны через get_book"""
+    lines = ('bid', 'ask', 'bidsize', 'asksize')  # Лучшие цены и кол-во в штуках. Close = середина спреда
+    params = (
+        ('depth', 10),  # Глубина стакана: 1, 10, 20, 30, 40, 50
+        ('history', 1000),  # Кол-во последних снимков стакана в кольцевом буфере
+    )
+    sleep_time_sec = 0.1  # Время ожидания в секундах, если не пришел новый снимок. Для снижения нагрузки/энергопотребления процессора
+
+    def islive(self):
+        """Стакан приходит только по подписке. Cerebro не будет запускать preload и runonce"""
+        return True
+
+    def __init__(self, **kwargs):
+        self.store = TKStore(**kwargs)  # Передаем параметры в хранилище Тинькофф
+        self.class_code, self.symbol = self.store.provider.dataname_to_class_code_symbol(self.p.dataname)  # По тикеру получаем код режима торгов и тикера
+        self.logger = logging.getLogger(f'TKOrderBook.{self.class_code}.{self.symbol}')  # Будем вести лог
+        si = self.store.get_symbol_info(self.class_code, self.symbol, self.store.priority_history)  # Спецификация тикера
+        self.figi = si.figi  # Уникальный код тикера
+        self.lot = si.lot  # Размер лота
+        self.slot_size = 4 * self.p.depth  # Снимок: цены покупки, кол-во покупки, цены продажи, кол-во продажи
+        self.book = array('d', [float('nan')]) * (self.p.history * self.slot_size)  # Кольцевой буфер снимков. Отсутствующие уровни = nan
+        self.times = array('d', [0.0]) * self.p.history  # Время снимков UTC в секундах
+        self.write_head = 0  # Кол-во начатых записей снимков. Увеличивается до записи снимка
+        self.head = 0  # Кол-во записанных снимков. Увеличивается только после записи снимка
+        self.read_head = 0  # Кол-во снимков на момент последней отдачи в ТС
+
+    def setenvironment(self, env):
+        """Добавление хранилища Тинькофф в cerebro"""
+        super(TKOrderBook, self).setenvironment(env)
+        env.addstore(self.store)  # Добавление хранилища Тинькофф в cerebro
+
+    def start(self):
+        super(TKOrderBook, self).start()
+        self.logger.debug('Запуск подписки на стакан')
+        self.store.subscribe_order_book(self.figi, self.p.depth, self.on_order_book)  # Подписываемся на стакан тикера
+        self.put_notification(self.LIVE)  # Истории нет, сразу получаем новые снимки
+
+    def on_order_book(self, order_book: OrderBook):
+        """Запись снимка стакана в кольцевой буфер. Вызывается из потока подписки. Писатель один, поэтому без блокировки. Читатели после копирования снимка проверяют, что он не был перезаписан"""
+        depth = self.p.depth
+        slot = self.head % self.p.history  # Номер снимка в кольцевом буфере
+        book = self.book
+        self.write_head += 1  # Начинаем запись снимка. Читатели этого слота будут повторять чтение
+        quotation_to_float = self.store.provider.quotation_to_float
+        for side, orders in enumerate((order_book.bids, order_book.asks)):  # Пробегаемся по покупкам и продажам
+            prices = slot * self.slot_size + side * 2 * depth  # Начало цен стороны стакана в буфере
+            levels = min(len(orders), depth)  # Кол-во пришедших уровней
+            for i in range(levels):  # Пробегаемся по всем пришедшим уровням
+                book[prices + i] = quotation_to_float(orders[i].price)  # Цена
+                book[prices + depth + i] = orders[i].quantity * self.lot  # Кол-во переводим из лотов в штуки
+            for i in range(levels, depth):  # Недостающие уровни
+                book[prices + i] = book[prices + depth + i] = float('nan')  # помечаем как отсутствующие
+        self.times[slot] = order_book.time.seconds + order_book.time.nanos / 1e9  # Время снимка
+        self.head += 1  # Публикуем снимок
+
+    def _load(self):
+        """Загрузка последнего снимка стакана. Промежуточные снимки в ТС не подаются"""
+        while True:  # Пока не получим целый снимок
+            head = self.head  # Запоминаем кол-во записанных снимков. Поток подписки может его изменить
+            if head == self.read_head:  # Если новый снимок еще не появился
+                sleep(self.sleep_time_sec)  # Ждем для снижения нагрузки/энергопотребления процессора
+                return None  # то нового снимка нет, будем заходить еще
+            snapshot = self.get_snapshot(head - 1)  # Копия последнего снимка
+            if snapshot is not None:  # Если снимок не был перезаписан во время копирования
+                break  # то подаем его. Иначе берем новый последний снимок
+        self.read_head = head
+        book, snapshot_time = snapshot
+        depth = self.p.depth
+        bid, bidsize = book[0], book[depth]  # Лучшая покупка
+        ask, asksize = book[2 * depth], book[3 * depth]  # Лучшая продажа
+        mid = (bid + ask) / 2  # Середина спреда. nan, если одна из сторон стакана пустая
+        self.lines.datetime[0] = date2num(self.store.provider.utc_to_msk_datetime(datetime.fromtimestamp(snapshot_time, UTC)))  # Дату/время переводим из UTC в МСК
+        self.lines.open[0] = self.lines.high[0] = self.lines.low[0] = self.lines.close[0] = mid
+        self.lines.volume[0] = 0
+        self.lines.openinterest[0] = 0
+        self.lines.bid[0] = bid
+        self.lines.ask[0] = ask
+        self.lines.bidsize[0] = bidsize
+        self.lines.asksize[0] = asksize
+        return True  # Будем заходить сюда еще
+
+    def get_book(self, ago=0):
+        """Снимок стакана из кольцевого буфера
+
+        :param int ago: Сколько снимков назад от последнего поданного в ТС. Учитываются и промежуточные снимки
+        :return: Покупки и продажи в виде списков (цена, кол-во в штуках) от лучшей цены
+        """
+        index = self.read_head - 1 - ago  # Номер снимка с начала подписки
+        snapshot = self.get_snapshot(index) if ago >= 0 and index >= 0 else None  # Копия снимка
+        if snapshot is None:  # Если снимка нет или он уже вытеснен из буфера потоком подписки
+            raise IndexError(f'Снимок стакана {ago} назад недоступен')
+        book, _ = snapshot
+        depth = self.p.depth
+        sides = []
+        for side in range(2):  # Пробегаемся по покупкам и продажам
+            prices = side * 2 * depth  # Начало цен стороны стакана в снимке
+            sides.append([(book[prices + i], book[prices + depth + i]) for i in range(depth) if book[prices + i] == book[prices + i]])  # nan не равен сам себе
+        return sides[0], sides[1]
+
+    def get_snapshot(self, index):
+        """Копия снимка стакана из кольцевого буфера. Поток подписки пишет без блокировки, поэтому после копирования проверяем, что он не начал писать в слот снимка
+
+        :param int index: Номер записанного снимка с начала подписки
+        :return: Цены и кол-во снимка, время снимка UTC в секундах. None, если снимок вытеснен из буфера
+        """
+        slot = index % self.p.history  # Слот снимка в кольцевом буфере
+        book = self.book[slot * self.slot_size:(slot + 1) * self.slot_size]  # Копируем снимок
+        snapshot_time = self.times[slot]
+        if self.write_head - index > self.p.history:  # Если после копирования поток подписки уже начал писать в этот слот новый снимок
+            return None  # то снимок перезаписан
+        return book, snapshot_time
+
+    def stop(self):
+        super(TKOrderBook, self).stop()
+        self.logger.info('Отмена подписки на стакан')
+        self.store.subscribe_order_book(self.figi, self.p.depth, self.on_order_book, False)  # Отменяем подписку на стакан тикера
+        self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения новых снимков
@@ -1,13 +1,23 @@
-from collections import deque
-from datetime import datetime, UTC
-from threading import Thread
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, date, time, timedelta, timezone, UTC
+from threading import Thread, Condition, Event, Lock, get_ident  # get_ident - профилировщик принадлежит одному потоку
+from time import monotonic, sleep, perf_counter, thread_time  # Замеры времени этапов при профилировании
+from concurrent.futures import ThreadPoolExecutor, wait  # Параллельные запросы бар по расписанию
+from heapq import heappush, heappop  # Очередь ожидания запросов по приоритетам
+from itertools import count
 import logging
 
 from backtrader.metabase import MetaParams
 from backtrader.utils.py3 import with_metaclass
 
 from TinkoffPy import TinkoffPy
-from TinkoffPy.grpc.marketdata_pb2 import Candle
+from TinkoffPy.grpc.marketdata_pb2 import (
+    Candle, LastPrice, Trade, OrderBook, MarketDataRequest, SubscriptionAction, SubscribeLastPriceRequest, LastPriceInstrument,
+    SubscribeTradesRequest, TradeInstrument, SubscribeOrderBookRequest, OrderBookInstrument)
+from TinkoffPy.grpc.orders_pb2 import OrderStateStreamRequest, OrderStateStreamResponse
+from TinkoffPy.grpc.instruments_pb2 import TradingSchedulesRequest
+from grpc import RpcError
 
 
 class MetaSingleton(MetaParams):
@@ -24,9 +34,60 @@ class MetaSingleton(MetaParams):
         return cls._singleton  # Возвращаем экземпляр класса
 
 
+class TokenBucket:
+    """Ведро токенов с очередью ожидания по приоритетам. Ограничивает кол-во запросов к сервису Тинькофф в минуту"""
+    def __init__(self, limit):
+        """Инициализация ведра токенов
+
+        :param int limit: Максимальное кол-во запросов в минуту
+        """
+        self.capacity = max(1, limit // 10)  # Размер ведра. Столько запросов можно сделать сразу
+        self.rate = max(1, limit - self.capacity) / 60  # Скорость наполнения ведра в токенах в секунду. Вместе с размером ведра не превышает лимит за минуту
+        self.tokens = self.capacity  # Сначала ведро полное
+        self.updated = monotonic()  # Время последнего наполнения ведра
+        self.condition = Condition()  # Ожидание токена
+        self.waiters = []  # Очередь ожидания (приоритет, номер по порядку)
+        self.counter = count()  # Номера по порядку. При одинаковом приоритете первым получит токен тот, кто раньше встал в очередь
+
+    def acquire(self, priority) -> None:
+        """Получение токена. Ждем, пока не подойдет очередь по приоритету и не появится токен
+
+        :param int priority: Приоритет запроса. Чем меньше, тем раньше получим токен
+        """
+        with self.condition:
+            waiter = (priority, next(self.counter))  # Место в очереди ожидания
+            heappush(self.waiters, waiter)  # Встаем в очередь
+            while True:
+                now = monotonic()  # Текущее время
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)  # Наполняем ведро за прошедшее время
+                self.updated = now  # Запоминаем время наполнения ведра
+                if self.waiters[0] != waiter:  # Если очередь еще не подошла
+                    self.condition.wait()  # то ждем, пока ее не продвинут
+                elif self.tokens < 1:  # Если очередь подошла, но токена нет
+                    self.condition.wait((1 - self.tokens) / self.rate)  # то ждем появления токена
+                else:  # Если очередь подошла и есть токен
+                    heappop(self.waiters)  # Выходим из очереди
+                    self.tokens -= 1  # Забираем токен
+                    self.condition.notify_all()  # Продвигаем очередь
+                    return
+
+
 class TKStore(with_metaclass(MetaSingleton, object)):
     """Хранилище Тинькофф"""
     logger = logging.getLogger('TKStore')  # Будем вести лог
+    rate_limits = {'MarketDataServiceStub': 600, 'InstrumentsServiceStub': 200, 'OrdersServiceStub': 100,
+                   'StopOrdersServiceStub': 50, 'OperationsServiceStub': 200}  # Лимиты запросов в минуту по сервисам Тинькофф
+    # Приоритеты запросов. Чем меньше, тем раньше запрос будет отправлен
+    priority_order = 0  # Постановка заявок
+    priority_cancel = 1  # Снятие заявок
+    priority_new_bars = 2  # Новые бары по расписанию
+    priority_portfolio = 3  # Портфель
+    priority_history = 4  # История
+    prefetch_workers = 16  # Кол-во данных, получающих бары из файла и истории параллельно при запуске хранилища
+    schedule_workers = 16  # Кол-во параллельных запросов бар по расписанию
+    trading_schedules_period = timedelta(days=14)  # Период запроса расписания торгов биржи. Периоды выровнены по датам, чтобы расписание было общим для всех данных биржи
+    order_state_reconnect_sec = 5  # Через сколько секунд переподключать подписку на статусы заявок после ее обрыва
+    schedule_retry_sec = 1  # Через сколько секунд повторять запрос бара по расписанию, если ответ не пришел или бар не получен
 
     BrokerCls = None  # Класс брокера будет задан из брокера
     DataCls = None  # Класс данных будет задан из данных
@@ -41,15 +102,86 @@ class TKStore(with_metaclass(MetaSingleton, object)):
         """Возвращает новый экземпляр класса брокера с заданными параметрами"""
         return cls.BrokerCls(*args, **kwargs)
 
-    def __init__(self, provider=TinkoffPy()):
+    def __init__(self, provider=None, profile=False, profiler=None):
+        """Инициализация хранилища Тинькофф
+
+        :param TinkoffPy provider: Провайдер Тинькофф. По умолчанию, подключаемся ко всем торговым счетам
+        :param bool profile: Замерять время, кол-во бар и байт по этапам запуска данных
+        :param profiler: Профилировщик, который включается на время этапов. Например, cProfile.Profile() или pyinstrument.Profiler()
+            Профилируется только один поток. С профилировщиком бары по всем данным получаются по очереди в потоке запуска хранилища
+        """
         super(TKStore, self).__init__()
+        self.profile = profile  # Замеры по этапам
+        self.profiler = profiler  # Профилировщик
+        self.profiler_depth = 0  # Кол-во выполняемых этапов. Профилировщик включен, пока выполняется хотя бы один этап
+        self.profiler_thread = None  # Поток, который включил профилировщик. cProfile профилирует только его
+        self.stats_lock = Lock()  # Замеры ведутся из разных потоков
+        self.stats = defaultdict(dict)  # Замеры по данным и этапам
         self.notifs = deque()  # Уведомления хранилища
-        self.provider = provider  # Подключаемся ко всем торговым счетам
+        with self.measure('TKStore', 'TinkoffPy'):  # Замеряем подключение
+            self.provider = provider or TinkoffPy()  # Подключаемся ко всем торговым счетам
         self.new_bars = []  # Новые бары по всем подпискам на тикеры из Тинькофф
+        self.datas = []  # Все созданные данные Тинькофф
+        self.schedule_groups = {}  # Группы данных, получающих новые бары по одному расписанию и временнОму интервалу
+        self.schedule_lock = Lock()  # Группы данных меняются из разных потоков
+        self.buckets = {service: TokenBucket(limit) for service, limit in self.rate_limits.items()}  # Ведра токенов по сервисам Тинькофф
+        self.symbols = {}  # Спецификации тикеров по коду режима торгов и тикеру
+        self.trading_sessions = {}  # Торговые сессии по бирже и дате начала периода расписания
+        self.trading_sessions_locks = defaultdict(Lock)  # Блокировки запросов расписания по бирже и дате начала периода. Данные одной биржи ждут один запрос
+        self.trading_sessions_lock = Lock()  # Блокировки запросов расписания создаются из разных потоков
+        self.figi_symbols = {}  # Спецификации тикеров по уникальным кодам тикеров
+        self.last_prices = {}  # Последние цены по подпискам на тикеры из Тинькофф
+        self.last_price_figis = set()  # Уникальные коды тикеров, на последние цены которых есть подписка
+        self.trade_handlers = defaultdict(list)  # Обработчики сделок по уникальным кодам тикеров
+        self.order_book_handlers = defaultdict(list)  # Обработчики стаканов по уникальным кодам тикеров и глубине стакана
+        self.order_state_live = False  # Статусы заявок приходят по подписке
+        self.order_state_session = 0  # Номер подключения подписки на статусы заявок. Меняется при каждом переподключении
+        self.order_state_exit_event = Event()  # Событие выхода из потока подписки на статусы заявок
+        self.on_order_state = self.provider.default_handler  # Обработчик изменения статуса заявки будет задан из брокера
 
     def start(self):
         self.provider.on_candle = self.on_candle   # Обработчик новых баров по подписке из Тинькофф
+        self.provider.on_last_price = self.on_last_price  # Обработчик последних цен по подписке из Тинькофф
+        self.provider.on_trade = self.on_trade  # Обработчик сделок по подписке из Тинькофф
+        self.provider.on_orderbook = self.on_order_book  # Обработчик стаканов по подписке из Тинькофф
         Thread(target=self.provider.subscriptions_marketdata_handler, name='SubscriptionsMarketdataThread').start()  # Создаем и запускаем поток обработки подписок на биржевую информацию
+        self.prefetch()  # Получаем бары из файлов и истории по всем данным до их запуска
+
+    def prefetch(self) -> None:
+        """Параллельное получение бар из файлов и истории по всем данным. Cerebro запускает хранилище до данных
+        Время запуска ограничено самыми долгими данными, а не суммой по всем данным. Данные с одним файлом истории получают бары по очереди
+        """
+        files = defaultdict(list)  # Данные по файлам истории
+        for data in self.datas:  # Пробегаемся по всем данным
+            if not data.prefetched:  # Если бары по данным еще не получены
+                files[data.file_name].append(data)  # то добавляем данные к их файлу истории
+        if len(files) < 2:  # Если параллельно получать нечего
+            return  # то данные получат бары сами при запуске
+        self.logger.debug(f'Параллельное получение бар по файлам истории: {len(files)}')
+        start = monotonic()  # Время начала получения бар
+        if self.profiler:  # Если профилировщик задан, то получаем бары по очереди в текущем потоке. Профилировщик снимает только один поток
+            self.start_profiler()  # Включаем профилировщик на все время получения бар
+            try:
+                for file_name, datas in files.items():  # Пробегаемся по всем файлам истории
+                    self.prefetch_datas(file_name, datas)  # Получаем бары по файлу истории
+            finally:
+                self.stop_profiler()  # Выключаем профилировщик
+        else:  # Если профилировщика нет
+            with ThreadPoolExecutor(max_workers=self.prefetch_workers, thread_name_prefix='Prefetch') as executor:  # Потоки для получения бар
+                executor.map(self.prefetch_datas, files.keys(), files.values())  # Получаем бары по всем файлам истории. Выход из блока дожидается всех потоков
+        self.logger.debug(f'Бары по всем файлам истории получены за {monotonic() - start:.3f} с')
+
+    def prefetch_datas(self, file_name, datas) -> None:
+        """Получение бар по данным с одним файлом истории по очереди
+
+        :param str file_name: Файл истории
+        :param list datas: Данные с этим файлом истории
+        """
+        try:
+            for data in datas:  # Пробегаемся по всем данным
+                data.prefetch()  # Получаем бары из файла и истории
+        except Exception as e:  # Если при получении бар произошла ошибка
+            self.logger.error(f'Ошибка получения бар по файлу {file_name}: {e}. Бары будут получены при запуске данных')
 
     def put_notification(self, msg, *args, **kwargs):
         self.notifs.append((msg, args, kwargs))
@@ -59,8 +191,105 @@ class TKStore(with_metaclass(MetaSingleton, object)):
         self.notifs.append(None)
         return [x for x in iter(self.notifs.popleft, None)]
 
+    def call_function(self, stub, method, request, priority):
+        """Вызов функции Тинькофф через планировщик запросов с учетом лимитов сервиса и приоритета запроса
+
+        :param stub: Сервис Тинькофф
+        :param str method: Название функции сервиса
+        :param request: Запрос
+        :param int priority: Приоритет запроса
+        :return: Ответ на запрос или None, если произошла ошибка
+        """
+        bucket = self.buckets.get(type(stub).__name__)  # Ведро токенов сервиса
+        if bucket:  # Если для сервиса задан лимит запросов
+            bucket.acquire(priority)  # то ждем своей очереди и токена
+        return self.provider.call_function(getattr(stub, method), request)
+
+    def get_symbol_info(self, class_code, symbol, priority):
+        """Спецификация тикера. Запрос к Тинькофф идет через планировщик запросов только при первом обращении, затем берется из кэша
+
+        :param str class_code: Код режима торгов
+        :param str symbol: Тикер
+        :param int priority: Приоритет запроса
+        :return: Спецификация тикера или None, если тикер не найден
+        """
+        si = self.symbols.get((class_code, symbol))  # Спецификация тикера из кэша
+        if si is None:  # Если спецификации в кэше нет
+            self.acquire_instruments(priority)  # то ждем своей очереди и токена
+            si = self.provider.get_symbol_info(class_code, symbol)  # Получаем спецификацию тикера
+            self.add_symbol_info(si)  # Добавляем спецификацию в кэш
+            if si:  # Если тикер найден
+                self.symbols[(class_code, symbol)] = si  # то кэшируем спецификацию и по запрошенному тикеру
+        return si
+
+    def figi_to_symbol_info(self, figi, priority):
+        """Спецификация тикера по уникальному коду. Запрос к Тинькофф идет через планировщик запросов только при первом обращении, затем берется из кэша
+
+        :param str figi: Уникальный код тикера
+        :param int priority: Приоритет запроса
+        :return: Спецификация тикера или None, если тикер не найден
+        """
+        si = self.figi_symbols.get(figi)  # Спецификация тикера из кэша
+        if si is None:  # Если спецификации в кэше нет
+            self.acquire_instruments(priority)  # то ждем своей очереди и токена
+            si = self.provider.figi_to_symbol_info(figi)  # Получаем спецификацию тикера
+            self.add_symbol_info(si)  # Добавляем спецификацию в кэш
+        return si
+
+    def get_trading_sessions(self, exchange, from_date, priority) -> tuple:
+        """Торговые сессии биржи за период расписания, в который входит дата
+        Периоды выровнены по датам, поэтому расписание периода запрашивается один раз для всех данных биржи и берется из кэша
+
+        :param str exchange: Биржа
+        :param date from_date: Дата
+        :param int priority: Приоритет запроса
+        :return: Сессии периода (дата и время начала, дата и время окончания) по МСК или None, если расписание не получено. Дата начала следующего периода
+        """
+        days = self.trading_schedules_period.days  # Длительность периода в днях
+        period_from = date.fromordinal(from_date.toordinal() // days * days)  # Дата начала периода
+        period_to = period_from + self.trading_schedules_period  # Дата начала следующего периода
+        key = (exchange, period_from)  # Ключ кэша
+        with self.trading_sessions_lock:
+            lock = self.trading_sessions_locks[key]  # Блокировка запроса расписания периода
+        with lock:  # Если расписание периода уже запрашивается, то ждем ответа
+            sessions = self.trading_sessions.get(key)  # Сессии периода из кэша
+            if sessions is None:  # Если сессий в кэше нет
+                request = TradingSchedulesRequest(exchange=exchange)  # Запрос расписания торгов
+                getattr(request, 'from').seconds = int(datetime.combine(period_from, time.min, timezone.utc).timestamp())  # т.к. from - ключевое слово в Python, то получаем атрибут from из атрибута интервала
+                getattr(request, 'to').seconds = int(datetime.combine(period_to, time.min, timezone.utc).timestamp())  # Аналогично будем работать с атрибутом to для единообразия
+                response = self.call_function(self.provider.stub_instruments, 'TradingSchedules', request, priority)  # Получаем ответ на запрос расписания
+                if not response:  # Если в ответ ничего не получили
+                    self.logger.warning(f'Ошибка запроса расписания торгов {exchange} с {period_from}')
+                    return None, period_to  # то расписание не получено. Не кэшируем
+                sessions = sorted((self.provider.timestamp_to_msk_datetime(day.start_time), self.provider.timestamp_to_msk_datetime(day.end_time))
+                                  for trading_schedule in response.exchanges for day in trading_schedule.days if day.is_trading_day)  # Сессии торговых дней
+                self.trading_sessions[key] = sessions  # Кэшируем сессии периода
+        return sessions, period_to
+
+    def acquire_instruments(self, priority) -> None:
+        """Ожидание очереди и токена на запрос к сервису инструментов Тинькофф"""
+        bucket = self.buckets.get('InstrumentsServiceStub')  # Ведро токенов сервиса инструментов
+        if bucket:  # Если для сервиса задан лимит запросов
+            bucket.acquire(priority)  # то ждем своей очереди и токена
+
+    def add_symbol_info(self, si) -> None:
+        """Добавление спецификации тикера в кэш. Не найденные тикеры не кэшируем"""
+        if si:  # Если тикер найден
+            self.symbols[(si.class_code, si.ticker)] = si  # то кэшируем спецификацию по коду режима торгов и тикеру
+            self.figi_symbols[si.figi] = si  # и по уникальному коду тикера
+
     def stop(self):
+        self.order_state_exit_event.set()  # Подписку на статусы заявок больше не переподключаем
+        if self.profile:  # Если велись замеры по этапам
+            self.logger.info(f'Замеры по этапам:\n{self.get_stats_summary()}')  # то выводим их в лог
+        with self.schedule_lock:
+            for group in self.schedule_groups.values():  # Пробегаемся по всем группам получения новых бар по расписанию
+                group['exit_event'].set()  # Отменяем расписание
+            self.schedule_groups.clear()  # Групп больше нет
         self.provider.on_candle = self.provider.default_handler  # Возвращаем обработчик по умолчанию
+        self.provider.on_last_price = self.provider.default_handler  # Возвращаем обработчик по умолчанию
+        self.provider.on_trade = self.provider.default_handler  # Возвращаем обработчик по умолчанию
+        self.provider.on_orderbook = self.provider.default_handler  # Возвращаем обработчик по умолчанию
         self.provider.close_channel()  # Закрываем канал перед выходом
 
     def on_candle(self, candle: Candle):
@@ -72,3 +301,288 @@ class TKStore(with_metaclass(MetaSingleton, object)):
                    close=self.provider.quotation_to_float(candle.close),
                    volume=int(candle.volume))
         self.new_bars.append(dict(guid=(candle.figi, candle.interval), data=bar))
+
+    def subscribe_last_price(self, figi) -> None:
+        """Подписка на последние цены тикера
+
+        :param str figi: Уникальный код тикера
+        """
+        if figi in self.last_price_figis:  # Если подписка уже есть
+            return  # то выходим, дальше не продолжаем
+        self.last_price_figis.add(figi)  # Запоминаем подписку
+        self.logger.debug(f'Запуск подписки на последние цены {figi}')
+        self.provider.subscription_marketdata_queue.put(  # Ставим в буфер команд подписки на биржевую информацию
+            MarketDataRequest(subscribe_last_price_request=SubscribeLastPriceRequest(  # запрос на последние цены
+                subscription_action=SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE,  # подписка
+                instruments=(LastPriceInstrument(instrument_id=figi),))))  # на тикер
+
+    def on_last_price(self, last_price: LastPrice):
+        """Обработка прихода последней цены"""
+        self.last_prices[last_price.figi] = self.provider.quotation_to_float(last_price.price)
+
+    def subscribe_trades(self, figi, handler, subscribe=True) -> None:
+        """Подписка на сделки тикера / отмена подписки. Сделки передаются в обработчик без сохранения в хранилище
+
+        :param str figi: Уникальный код тикера
+        :param handler: Обработчик сделки
+        :param bool subscribe: True - подписка, False - отмена подписки
+        """
+        self.subscribe(self.trade_handlers, figi, handler, subscribe, lambda action: MarketDataRequest(subscribe_trades_request=SubscribeTradesRequest(
+            subscription_action=action, instruments=(TradeInstrument(instrument_id=figi),))))  # Запрос на сделки по тикеру
+
+    def subscribe_order_book(self, figi, depth, handler, subscribe=True) -> None:
+        """Подписка на стакан тикера / отмена подписки. Стаканы передаются в обработчик без сохранения в хранилище
+
+        :param str figi: Уникальный код тикера
+        :param int depth: Глубина стакана: 1, 10, 20, 30, 40, 50
+        :param handler: Обработчик стакана
+        :param bool subscribe: True - подписка, False - отмена подписки
+        """
+        self.subscribe(self.order_book_handlers, (figi, depth), handler, subscribe, lambda action: MarketDataRequest(subscribe_order_book_request=SubscribeOrderBookRequest(
+            subscription_action=action, instruments=(OrderBookInstrument(instrument_id=figi, depth=depth),))))  # Запрос на стакан тикера заданной глубины
+
+    def subscribe(self, handlers, key, handler, subscribe, request) -> None:
+        """Подписка на биржевую информацию тикера / отмена подписки. На тикер подписываемся один раз для всех обработчиков
+
+        :param dict handlers: Обработчики по ключам подписки
+        :param key: Ключ подписки. Уникальный код тикера, для стакана - уникальный код тикера и глубина стакана
+        :param handler: Обработчик
+        :param bool subscribe: True - подписка, False - отмена подписки
+        :param request: Функция создания запроса по действию подписки
+        """
+        if subscribe:  # Если подписываемся
+            handlers[key].append(handler)  # то добавляем обработчик
+            if len(handlers[key]) == 1:  # Если это первый обработчик подписки
+                self.provider.subscription_marketdata_queue.put(request(SubscriptionAction.SUBSCRIPTION_ACTION_SUBSCRIBE))  # то ставим в буфер команд подписки на биржевую информацию
+        elif handler in handlers.get(key, ()):  # Если отменяем подписку обработчика
+            handlers[key].remove(handler)  # то удаляем обработчик
+            if len(handlers[key]) == 0:  # Если обработчиков подписки больше нет
+                del handlers[key]  # то удаляем подписку
+                self.provider.subscription_marketdata_queue.put(request(SubscriptionAction.SUBSCRIPTION_ACTION_UNSUBSCRIBE))  # и ставим в буфер команд отмену подписки
+
+    def on_trade(self, trade: Trade):
+        """Обработка прихода сделки"""
+        for handler in tuple(self.trade_handlers.get(trade.figi, ())):  # Пробегаемся по копии обработчиков сделок тикера. Обработчики могут меняться из другого потока
+            handler(trade)  # Передаем сделку в обработчик
+
+    def on_order_book(self, order_book: OrderBook):
+        """Обработка прихода стакана"""
+        for handler in tuple(self.order_book_handlers.get((order_book.figi, order_book.depth), ())):  # Пробегаемся по копии обработчиков стаканов тикера этой глубины. Обработчики могут меняться из другого потока
+            handler(order_book)  # Передаем стакан в обработчик
+
+    def subscriptions_order_state_handler(self, account_ids):
+        """Поток обработки подписки на изменение статусов заявок. При обрыве подписка переподключается до остановки хранилища
+        Пока подписки нет, брокер снимает заявки по ответу на запрос отмены
+
+        :param list account_ids: Список торговых счетов
+        """
+        self.order_state_exit_event.clear()  # Поток запускается брокером. Хранилище могло быть остановлено при прошлом запуске
+        while not self.order_state_exit_event.is_set():  # Пока хранилище не остановлено
+            events = self.provider.stub_orders_stream.OrderStateStream(request=OrderStateStreamRequest(accounts=account_ids), metadata=self.provider.metadata)  # Подписка на статусы заявок
+            try:
+                for event in events:  # Пробегаемся по значениям подписки до ее закрытия
+                    event: OrderStateStreamResponse
+                    if event.HasField('subscription'):  # Если пришел статус подписки
+                        self.logger.debug('Подписка на статусы заявок запущена')
+                        self.order_state_session += 1  # Новое подключение. Статусы, пришедшие до него, могли быть пропущены
+                        self.order_state_live = True  # то статусы заявок будут приходить по подписке
+                    elif event.HasField('order_state'):  # Если пришел статус заявки
+                        self.on_order_state(event.order_state)  # то обрабатываем его
+            except RpcError as e:  # При закрытии канала или обрыве подписки попадем на эту ошибку
+                if self.order_state_exit_event.is_set():  # Если хранилище остановлено
+                    self.logger.debug('Подписка на статусы заявок закрыта')
+                    break  # то выходим из потока
+                self.logger.warning(f'Подписка на статусы заявок прервана: {e}')
+            finally:
+                self.order_state_live = False  # Статусы заявок больше не приходят по подписке
+            if self.order_state_exit_event.wait(self.order_state_reconnect_sec):  # Ждем перед переподключением или события выхода из потока
+                break  # Если хранилище остановлено, то выходим из потока
+            self.logger.info('Переподключение подписки на статусы заявок')
+
+    def add_schedule_data(self, data) -> None:
+        """Добавление данных в группу получения новых бар по расписанию. Бары по всем тикерам группы запрашиваются параллельно
+
+        :param data: Данные Тинькофф
+        """
+        key = (id(data.p.schedule), data.tf)  # Группа по расписанию и временнОму интервалу
+        with self.schedule_lock:
+            group = self.schedule_groups.get(key)  # Группа данных
+            if group is None:  # Если группы еще нет
+                group = self.schedule_groups[key] = dict(schedule=data.p.schedule, tf=data.tf, datas=[], exit_event=Event())  # то создаем ее
+                Thread(target=self.stream_schedule_bars, args=(group,), name=f'ScheduleBarsThread.{data.tf}').start()  # Создаем и запускаем получение новых бар по расписанию в потоке
+            group['datas'].append(data)  # Добавляем данные в группу
+
+    def remove_schedule_data(self, data) -> None:
+        """Удаление данных из группы получения новых бар по расписанию. Группа без данных отменяет расписание
+
+        :param data: Данные Тинькофф
+        """
+        key = (id(data.p.schedule), data.tf)  # Группа по расписанию и временнОму интервалу
+        with self.schedule_lock:
+            group = self.schedule_groups.get(key)  # Группа данных
+            if group is None or not any(group_data is data for group_data in group['datas']):  # Если данных нет в группе. Линии BackTrader переопределяют ==, поэтому сравниваем объекты
+                return  # то выходим, дальше не продолжаем
+            group['datas'] = [group_data for group_data in group['datas'] if group_data is not data]  # Удаляем данные из группы. Поток расписания берет копию списка
+            if len(group['datas']) == 0:  # Если в группе больше нет данных
+                group['exit_event'].set()  # то отменяем расписание
+                del self.schedule_groups[key]  # Удаляем группу
+
+    def stream_schedule_bars(self, group) -> None:
+        """Поток получения новых бар по расписанию биржи для группы данных
+
+        :param dict group: Группа данных
+        """
+        schedule, tf = group['schedule'], group['tf']  # Расписание и временной интервал группы
+        self.logger.debug(f'Запуск получения новых бар {tf} по расписанию')
+        executor = ThreadPoolExecutor(max_workers=self.schedule_workers, thread_name_prefix=f'ScheduleBars.{tf}')  # Потоки для параллельных запросов
+        while True:
+            market_datetime_now = schedule.utc_to_msk_datetime(datetime.now(UTC))  # Текущее время на бирже
+            trade_bar_open_datetime = schedule.trade_bar_open_datetime(market_datetime_now, tf)  # Дата и время открытия бара, который будем получать
+            trade_bar_close_datetime = schedule.trade_bar_close_datetime(market_datetime_now, tf)  # Дата и время закрытия бара, который будем получать
+            trade_bar_request_datetime = schedule.trade_bar_request_datetime(market_datetime_now, tf)  # Дата и время запроса бара на бирже
+            sleep_time_secs = (trade_bar_request_datetime - market_datetime_now).total_seconds()  # Время ожидания в секундах
+            self.logger.debug(f'Получение новых бар {tf} с {trade_bar_open_datetime:%d.%m.%Y %H:%M} по расписанию в {trade_bar_request_datetime:%d.%m.%Y %H:%M}. Ожидание {sleep_time_secs} с')
+            if group['exit_event'].wait(sleep_time_secs):  # Ждем нового бара или события выхода из потока
+                self.logger.warning(f'Отмена получения новых бар {tf} по расписанию')
+                executor.shutdown(wait=False, cancel_futures=True)  # Не ждем незавершенные запросы
+                return  # Выходим из потока, дальше не продолжаем
+            deadline = monotonic() + (trade_bar_close_datetime - trade_bar_open_datetime).total_seconds()  # Бары должны успеть получить до запроса следующего бара
+            self.get_schedule_bars(executor, list(group['datas']), trade_bar_open_datetime, trade_bar_close_datetime, deadline)
+
+    def get_schedule_bars(self, executor, datas, trade_bar_open_datetime, trade_bar_close_datetime, deadline) -> None:
+        """Параллельное получение нового бара по всем тикерам группы до крайнего срока
+        Если бар по тикеру не получен или ответ запаздывает, то повторяем запрос
+
+        :param ThreadPoolExecutor executor: Потоки для параллельных запросов
+        :param list datas: Данные Тинькофф
+        :param datetime trade_bar_open_datetime: Дата и время открытия бара по МСК
+        :param datetime trade_bar_close_datetime: Дата и время закрытия бара по МСК
+        :param float deadline: Крайний срок получения бар по monotonic
+        """
+        start = monotonic()  # Время начала запросов
+        futures = {}  # Запросы, на которые еще не пришел ответ
+        received = set()  # guid данных, по которым бар получен
+        retry = datas  # Данные, по которым нужно отправить запрос
+        while True:
+            for data in retry:  # Пробегаемся по всем данным, по которым нужно отправить запрос
+                futures[executor.submit(data.get_schedule_bar, trade_bar_open_datetime, trade_bar_close_datetime)] = data  # Отправляем запрос
+            timeout = min(self.schedule_retry_sec, deadline - monotonic())  # Сколько ждем ответов
+            if timeout <= 0:  # Если крайний срок наступил
+                break  # то больше не ждем
+            done, _ = wait(futures, timeout=timeout)  # Ждем ответов на все запросы
+            for future in done:  # Пробегаемся по всем пришедшим ответам
+                data = futures.pop(future)  # Данные запроса
+                try:
+                    bar = future.result()  # Бар или None
+                except Exception as e:  # Ошибка по одному тикеру не должна останавливать получение бар по остальным тикерам группы
+                    self.logger.error(f'Ошибка получения бара по расписанию {data.file}: {e!r}')
+                    bar = None  # Бар не получен
+                if bar and data.guid not in received:  # Если бар получен впервые (на повторный запрос ответ мог прийти раньше)
+                    received.add(data.guid)  # Запоминаем, что бар получен
+                    data.fetch_time_sec = monotonic() - start  # Время получения бара от запроса
+                    self.new_bars.append(dict(guid=data.guid, data=bar))  # Добавляем в хранилище новых бар
+            in_flight = [data.guid for data in futures.values()]  # guid данных, по которым запросы еще выполняются
+            retry = [data for data in datas if data.guid not in received and in_flight.count(data.guid) < 2]  # Повторяем запрос, если ответа нет, но не больше 2-х одновременных запросов по тикеру
+            if len(received) == len(datas):  # Если все бары получены
+                break  # то запоздавшие ответы на повторные запросы не ждем
+            if len(done) > 0 and len(futures) == 0:  # Если все ответы пришли, но не по всем тикерам есть бары
+                sleep(max(0.0, min(self.schedule_retry_sec, deadline - monotonic())))  # то ждем перед повтором запроса, чтобы бар успел сформироваться
+        missed = [data.file for data in datas if data.guid not in received]  # Тикеры, по которым бар не получен
+        self.logger.debug(f'Получено бар по расписанию: {len(received)} из {len(datas)} за {monotonic() - start:.3f} с' + (f'. Не получены: {", ".join(missed)}' if missed else ''))
+
+    # Профилирование
+
+    @contextmanager
+    def measure(self, name, phase):
+        """Замер времени этапа. Если замеры не ведутся, то ничего не делаем
+
+        :param str name: Название данных
+        :param str phase: Название этапа
+        """
+        if not self.profile:  # Если замеры не ведутся
+            yield  # то просто выполняем этап
+            return  # выходим, дальше не продолжаем
+        self.start_profiler()  # Включаем профилировщик
+        wall, cpu = perf_counter(), thread_time()  # Время и процессорное время потока в начале этапа
+        try:
+            yield  # Выполняем этап
+        finally:
+            with self.stats_lock:
+                stat = self.get_stat(name, phase)  # Замеры этапа
+                stat['calls'] += 1  # Кол-во выполнений этапа
+                stat['wall'] += perf_counter() - wall  # Время выполнения
+                stat['cpu'] += thread_time() - cpu  # Процессорное время выполнения
+            self.stop_profiler()  # Выключаем профилировщик
+
+    def profiled(self, name, phase, function):
+        """Функция с замером времени выполнения. Если замеры не ведутся, то функция не меняется
+
+        :param str name: Название данных
+        :param str phase: Название этапа
+        :param function: Функция
+        :return: Функция с замером времени выполнения
+        """
+        if not self.profile:  # Если замеры не ведутся
+            return function  # то функцию не меняем
+
+        def wrapper(*args, **kwargs):
+            with self.measure(name, phase):  # Замеряем время выполнения функции
+                return function(*args, **kwargs)
+        return wrapper
+
+    def add_stat(self, name, phase, bars=0, size=0) -> None:
+        """Добавление кол-ва бар и байт в замеры этапа
+
+        :param str name: Название данных
+        :param str phase: Название этапа
+        :param int bars: Кол-во бар
+        :param int size: Кол-во байт
+        """
+        if not self.profile:  # Если замеры не ведутся
+            return  # то выходим, дальше не продолжаем
+        with self.stats_lock:
+            stat = self.get_stat(name, phase)  # Замеры этапа
+            stat['bars'] += bars  # Кол-во бар
+            stat['bytes'] += size  # Кол-во байт
+
+    def get_stat(self, name, phase) -> dict:
+        """Замеры этапа данных. Если замеров еще нет, то создаем их"""
+        return self.stats[name].setdefault(phase, dict(calls=0, wall=0.0, cpu=0.0, bars=0, bytes=0))
+
+    def get_stats_summary(self) -> str:
+        """Сводка замеров по этапам: итоги по всем данным, затем по каждым данным"""
+        totals = {}  # Итоги по этапам
+        for phases in self.stats.values():  # Пробегаемся по всем данным
+            for phase, stat in phases.items():  # Пробегаемся по всем этапам
+                total = totals.setdefault(phase, dict(calls=0, wall=0.0, cpu=0.0, bars=0, bytes=0))  # Итоги этапа
+                for key, value in stat.items():  # Пробегаемся по всем замерам этапа
+                    total[key] += value  # Суммируем замер
+        rows = [f'{"Данные":<24}{"Этап":<24}{"Вызовов":>10}{"Время, с":>12}{"CPU, с":>12}{"Бар":>12}{"Байт":>14}']  # Заголовок
+        for name, phases in [('Итого', totals), *sorted(self.stats.items())]:  # Пробегаемся по итогам и всем данным
+            for phase, stat in sorted(phases.items(), key=lambda item: -item[1]['wall']):  # Этапы по убыванию времени выполнения
+                rows.append(f'{name:<24}{phase:<24}{stat["calls"]:>10}{stat["wall"]:>12.3f}{stat["cpu"]:>12.3f}{stat["bars"]:>12}{stat["bytes"]:>14}')
+        return '\n'.join(rows)
+
+    def start_profiler(self) -> None:
+        """Включение профилировщика на первом выполняемом этапе. Этапы других потоков профилировщик не включают и не выключают"""
+        if not self.profiler:  # Если профилировщика нет
+            return  # то выходим, дальше не продолжаем
+        with self.stats_lock:
+            if self.profiler_thread not in (None, get_ident()):  # Если профилировщик включен другим потоком
+                return  # то выходим, дальше не продолжаем
+            self.profiler_thread = get_ident()  # Профилировщик принадлежит текущему потоку
+            self.profiler_depth += 1  # Увеличиваем кол-во выполняемых этапов
+            if self.profiler_depth == 1:  # Если это первый выполняемый этап
+                (getattr(self.profiler, 'enable', None) or getattr(self.profiler, 'start'))()  # то включаем профилировщик: cProfile - enable, pyinstrument - start
+
+    def stop_profiler(self) -> None:
+        """Выключение профилировщика после последнего выполняемого этапа"""
+        if not self.profiler:  # Если профилировщика нет
+            return  # то выходим, дальше не продолжаем
+        with self.stats_lock:
+            if self.profiler_thread != get_ident():  # Если профилировщик включен другим потоком
+                return  # то выходим, дальше не продолжаем
+            self.profiler_depth -= 1  # Уменьшаем кол-во выполняемых этапов
+            if self.profiler_depth == 0:  # Если этапов больше нет
+                (getattr(self.profiler, 'disable', None) or getattr(self.profiler, 'stop'))()  # то выключаем профилировщик: cProfile - disable, pyinstrument - stop
+                self.profiler_thread = None  # Профилировщик свободен
@@ -0,0 +1,106 @@
+import logging  # Будем вести лог
+from collections import deque  # Сформированные бары по сделкам
+from datetime import datetime, UTC
+from threading import Lock  # Сделки приходят из потока подписки, бары забирает Cerebro
+from time import sleep, time
+
+from backtrader.feed import AbstractDataBase
+from backtrader import TimeFrame, date2num
+
+from BackTraderTinkoff import TKStore
+from TinkoffPy.grpc.marketdata_pb2 import Trade
+
+
+class TKTrades(AbstractDataBase):
+    """Бары по сделкам Тинькофф. Сделки из подписки собираются в секундные/минутные бары по мере прихода"""
+    params = (
+        ('timeframe', TimeFrame.Seconds),  # Временной интервал бар: секунды или минуты
+    )
+    flush_delay_sec = 1  # Через сколько секунд после окончания бара отдавать его в ТС, если новых сделок нет
+    sleep_time_sec = 0.1  # Время ожидания в секундах, если не пришел новый бар. Для снижения нагрузки/энергопотребления процессора
+
+    def islive(self):
+        """Сделки приходят только по подписке. Cerebro не будет запускать preload и runonce"""
+        return True
+
+    def __init__(self, **kwargs):
+        self.store = TKStore(**kwargs)  # Передаем параметры в хранилище Тинькофф
+        if self.p.timeframe == TimeFrame.Seconds:  # Секундные бары
+            self.period_sec = self.p.compression  # Длительность бара в секундах
+        elif self.p.timeframe == TimeFrame.Minutes:  # Минутные бары
+            self.period_sec = self.p.compression * 60  # Длительность бара в секундах
+        else:  # Для остальных временнЫх интервалов
+            raise NotImplementedError  # бары по сделкам не собираем
+        self.class_code, self.symbol = self.store.provider.dataname_to_class_code_symbol(self.p.dataname)  # По тикеру получаем код режима торгов и тикера
+        self.logger = logging.getLogger(f'TKTrades.{self.class_code}.{self.symbol}')  # Будем вести лог
+        si = self.store.get_symbol_info(self.class_code, self.symbol, self.store.priority_history)  # Спецификация тикера
+        self.figi = si.figi  # Уникальный код тикера
+        self.lot = si.lot  # Размер лота
+        self.lock = Lock()  # Блокировка текущего бара
+        self.bars = deque()  # Сформированные бары (время открытия UTC в секундах, open, high, low, close, volume)
+        self.bar_open_ts = None  # Время открытия текущего бара UTC в секундах. None - сделок еще не было
+        self.last_bar_open_ts = None  # Время открытия последнего сформированного бара UTC в секундах
+        self.bar_open = self.bar_high = self.bar_low = self.bar_close = 0.0  # Цены текущего бара
+        self.bar_volume = 0  # Объем текущего бара в штуках
+
+    def setenvironment(self, env):
+        """Добавление хранилища Тинькофф в cerebro"""
+        super(TKTrades, self).setenvironment(env)
+        env.addstore(self.store)  # Добавление хранилища Тинькофф в cerebro
+
+    def start(self):
+        super(TKTrades, self).start()
+        self.logger.debug('Запуск подписки на сделки')
+        self.store.subscribe_trades(self.figi, self.on_trade)  # Подписываемся на сделки тикера
+        self.put_notification(self.LIVE)  # Истории нет, сразу получаем новые бары
+
+    def on_trade(self, trade: Trade):
+        """Добавление сделки в текущий бар. Вызывается из потока подписки"""
+        price = self.store.provider.quotation_to_float(trade.price)  # Цена сделки
+        volume = trade.quantity * self.lot  # Кол-во переводим из лотов в штуки
+        bar_open_ts = trade.time.seconds // self.period_sec * self.period_sec  # Время открытия бара, в который попадает сделка
+        with self.lock:
+            if self.bar_open_ts is not None and bar_open_ts > self.bar_open_ts:  # Если сделка из следующего бара
+                self.flush_bar()  # то текущий бар сформирован
+            if self.bar_open_ts is None:  # Если это первая сделка бара
+                if self.last_bar_open_ts is not None:  # Если бар уже формировался
+                    bar_open_ts = max(bar_open_ts, self.last_bar_open_ts + self.period_sec)  # то запоздавшая сделка не должна попасть в уже отданный бар
+                self.bar_open_ts = bar_open_ts
+                self.bar_open = self.bar_high = self.bar_low = price
+                self.bar_volume = 0
+            else:  # Если сделка из текущего бара. Запоздавшие сделки тоже добавляем в текущий бар
+                self.bar_high = max(self.bar_high, price)
+                self.bar_low = min(self.bar_low, price)
+            self.bar_close = price
+            self.bar_volume += volume
+
+    def flush_bar(self) -> None:
+        """Перенос текущего бара в сформированные. Вызывается под блокировкой"""
+        self.bars.append((self.bar_open_ts, self.bar_open, self.bar_high, self.bar_low, self.bar_close, self.bar_volume))
+        self.last_bar_open_ts = self.bar_open_ts
+        self.bar_open_ts = None  # Ждем первую сделку следующего бара
+
+    def _load(self):
+        """Загрузка сформированного бара"""
+        if len(self.bars) == 0:  # Если сформированных бар нет
+            with self.lock:
+                if self.bar_open_ts is not None and time() >= self.bar_open_ts + self.period_sec + self.flush_delay_sec:  # Если время текущего бара вышло, а сделок следующего бара нет
+                    self.flush_bar()  # то отдаем текущий бар, не дожидаясь следующей сделки
+        if len(self.bars) == 0:  # Если новый бар еще не появился
+            sleep(self.sleep_time_sec)  # Ждем для снижения нагрузки/энергопотребления процессора
+            return None  # то нового бара нет, будем заходить еще
+        bar_open_ts, open_, high, low, close, volume = self.bars.popleft()  # Берем и удаляем первый бар
+        self.lines.datetime[0] = date2num(self.store.provider.utc_to_msk_datetime(datetime.fromtimestamp(bar_open_ts, UTC)))  # Дату/время переводим из UTC в МСК
+        self.lines.open[0] = open_
+        self.lines.high[0] = high
+        self.lines.low[0] = low
+        self.lines.close[0] = close
+        self.lines.volume[0] = volume
+        self.lines.openinterest[0] = 0
+        return True  # Будем заходить сюда еще
+
+    def stop(self):
+        super(TKTrades, self).stop()
+        self.logger.info('Отмена подписки на сделки')
+        self.store.subscribe_trades(self.figi, self.on_trade, False)  # Отменяем подписку на сделки тикера
+        self.put_notification(self.DISCONNECTED)  # Отправляем уведомление об окончании получения новых бар
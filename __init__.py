@@ -1,3 +1,5 @@
 from .TKStore import *
 from .TKData import *  # Также подключает данные в хранилище
 from .TKBroker import *  # Также подключает брокера в хранилище
+from .TKTrades import *  # Бары по сделкам
+from .TKOrderBook import *  # Стакан